@@ -0,0 +1,1151 @@
+#!/usr/bin/python3
+
+
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+import numpy
+
+try:
+	import resource
+except ModuleNotFoundError:
+	resource = None
+
+
+GEOMETRY_DIAMETER_MIN = 1
+GEOMETRY_DIAMETER_MAX = 20
+GEOMETRY_DIAMETER_DEF = 3
+
+GEOMETRY_SAFEZONE_MIN = 1
+GEOMETRY_SAFEZONE_MAX = 50
+GEOMETRY_SAFEZONE_DEF = 15
+
+GEOMETRY_BORDER = 2
+
+NEEDLE_MARGIN = 0 # mm kept between needle axes on top of the diameter
+
+LABEL_DTYPE = numpy.uint16
+NEEDLE_MAX = (numpy.iinfo(LABEL_DTYPE).max - 1) // 10 - 1 # one label left for the form needle
+
+LINE_RASTER = 'traverse' # sample|traverse
+
+CAPSULE_CHUNK = 1 << 20 # voxels
+
+DRAW_WORKERS = os.cpu_count() or 1
+
+HISTORY_BUDGET = 256 << 20 # bytes of rasters kept by undo states
+
+BUNDLE_VERSION = 1
+
+MASK_CACHE_LIMIT = 2 << 30 # bytes on disk
+
+OPTIMIZER_TIPS = 64 # target voxels tried as needle tips
+OPTIMIZER_DIRECTIONS = 256 # directions tried from every tip
+OPTIMIZER_SAMPLES = 2048 # target voxels scoring the coverage
+OPTIMIZER_POINTS = 64 # points sampling the avoid clearance of a candidate
+OPTIMIZER_CHUNK = 256 # candidates scored at once
+
+UNIT_FACTORS = {
+	1: 1e3, # meters
+	2: 1e0, # millimeters
+	3: 1e-3, # micrometers
+}
+
+TIMER_LOCK = threading.Lock()
+TIMER_NULL = contextlib.nullcontext()
+
+
+class Timer:
+
+	def __init__(self, timings, name):
+		self.timings = timings
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		elapsed = time.perf_counter() - self.start
+		with TIMER_LOCK:
+			self.timings[self.name] = self.timings.get(self.name, 0.) + elapsed
+
+
+def timer(timings, name):
+	# accumulates seconds into timings[name]; free when timings is None
+	if timings is None:
+		return TIMER_NULL
+	return Timer(timings, name)
+
+def memory_peak():
+	# peak resident set size in bytes, or None where unavailable
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if os.uname().sysname != 'Darwin':
+		peak *= 1024
+	return peak
+
+def geometry_check(geometry):
+	assert type(geometry) is dict
+	assert 'diameter' in geometry and type(geometry['diameter']) is int
+	assert geometry['diameter'] >= GEOMETRY_DIAMETER_MIN
+	assert geometry['diameter'] <= GEOMETRY_DIAMETER_MAX
+	assert 'safezone' in geometry and type(geometry['safezone']) is int
+	assert geometry['safezone'] >= GEOMETRY_SAFEZONE_MIN
+	assert geometry['safezone'] <= GEOMETRY_SAFEZONE_MAX
+	assert geometry['diameter'] <= 2 * geometry['safezone']
+
+def plan_check(plan):
+	assert type(plan) is dict
+	assert 'needles' in plan and type(plan['needles']) is list
+	assert len(plan['needles']) <= NEEDLE_MAX
+	for needle in plan['needles']:
+		assert type(needle) is dict
+		for which in ['entry', 'target']:
+			assert which in needle and type(needle[which]) is list
+			assert len(needle[which]) == 3
+			assert all(type(value) is float for value in needle[which])
+	geometry_check(plan)
+
+def pair2voxels_sample(entry_xyz, target_xyz, world2vox, zooms, shape):
+	entry_xyz = numpy.asarray(entry_xyz, dtype=float)
+	vector_xyz = numpy.asarray(target_xyz, dtype=float) - entry_xyz
+	num = numpy.dot(numpy.abs(vector_xyz), numpy.reciprocal(zooms))
+	num = round(num) + 1
+	t = numpy.linspace(0, 1, num)[:, numpy.newaxis]
+	points_xyz = entry_xyz + t * vector_xyz
+	points_ijk = points_xyz @ world2vox[:3, :3].T + world2vox[:3, 3]
+	points_ijk = numpy.floor(points_ijk + .5).astype(int)
+	inside = numpy.all((points_ijk >= 0) & (points_ijk < shape), axis=1)
+	return numpy.unique(points_ijk[inside], axis=0)
+
+def pair2voxels_traverse(entry_xyz, target_xyz, world2vox, shape):
+	# Amanatides & Woo; voxel i spans [i-.5, i+.5) like transformCoords(vround=True)
+	entry_ijk = world2vox[:3, :3] @ numpy.asarray(entry_xyz, dtype=float) + world2vox[:3, 3] + .5
+	target_ijk = world2vox[:3, :3] @ numpy.asarray(target_xyz, dtype=float) + world2vox[:3, 3] + .5
+	vector_ijk = target_ijk - entry_ijk
+	first = numpy.floor(entry_ijk).astype(int)
+	last = numpy.floor(target_ijk).astype(int)
+	step = numpy.sign(last - first)
+	T = []
+	A = []
+	for axis in range(len(first)):
+		if step[axis] > 0:
+			planes = numpy.arange(first[axis] + 1, last[axis] + 1)
+		elif step[axis] < 0:
+			planes = numpy.arange(first[axis], last[axis], -1)
+		else:
+			continue
+		T.append((planes - entry_ijk[axis]) / vector_ijk[axis])
+		A.append(numpy.full(planes.size, axis))
+	voxels = first[numpy.newaxis, :]
+	if T:
+		A = numpy.concatenate(A)[numpy.argsort(numpy.concatenate(T), kind='stable')]
+		delta = numpy.zeros((A.size, len(first)), dtype=int)
+		delta[numpy.arange(A.size), A] = step[A]
+		voxels = numpy.concatenate([voxels, first + numpy.cumsum(delta, axis=0)])
+	inside = numpy.all((voxels >= 0) & (voxels < shape), axis=1)
+	return voxels[inside]
+
+def pair2voxels(entry_xyz, target_xyz, world2vox, zooms, shape):
+	if LINE_RASTER == 'traverse':
+		return pair2voxels_traverse(entry_xyz, target_xyz, world2vox, shape)
+	elif LINE_RASTER == 'sample':
+		return pair2voxels_sample(entry_xyz, target_xyz, world2vox, zooms, shape)
+	else:
+		raise ValueError(LINE_RASTER)
+
+def voxels_box(voxels, shape):
+	if len(voxels) == 0:
+		return tuple(slice(0, 0) for _ in shape)
+	L = voxels.min(axis=0)
+	U = voxels.max(axis=0) + 1
+	return tuple(slice(l, u) for l, u in zip(L, U))
+
+def capsule_box(entry_xyz, target_xyz, world2vox, shape, radius):
+	points_ijk = numpy.asarray([entry_xyz, target_xyz], dtype=float) @ world2vox[:3, :3].T + world2vox[:3, 3]
+	extent = radius * numpy.linalg.norm(world2vox[:3, :3], axis=1)
+	L = numpy.ceil(points_ijk.min(axis=0) - extent).astype(int)
+	U = numpy.floor(points_ijk.max(axis=0) + extent).astype(int) + 1
+	L = numpy.clip(L, 0, shape)
+	U = numpy.clip(U, L, shape)
+	return tuple(slice(l, u) for l, u in zip(L, U))
+
+def capsule_distance(entry_xyz, target_xyz, vox2world, box, chunk=CAPSULE_CHUNK):
+	# world distance of voxel centres to the segment, expanded into scalar fields per (j, k)
+	entry_xyz = numpy.asarray(entry_xyz, dtype=float)
+	vector_xyz = numpy.asarray(target_xyz, dtype=float) - entry_xyz
+	length2 = numpy.dot(vector_xyz, vector_xyz)
+	I, J, K = (numpy.arange(s.start, s.stop) for s in box)
+	M = vox2world[:3, :3]
+	Q = J[:, numpy.newaxis, numpy.newaxis] * M[:, 1] + K[numpy.newaxis, :, numpy.newaxis] * M[:, 2]
+	Q += vox2world[:3, 3] - entry_xyz
+	QQ = numpy.einsum('jkx,jkx->jk', Q, Q)
+	QM = Q @ M[:, 0]
+	QV = Q @ vector_xyz
+	MM = numpy.dot(M[:, 0], M[:, 0])
+	MV = numpy.dot(M[:, 0], vector_xyz)
+	distance = numpy.empty((I.size, J.size, K.size), dtype=numpy.float32)
+	step = max(1, chunk // max(1, J.size * K.size))
+	for start in range(0, I.size, step):
+		i = I[start:start+step, numpy.newaxis, numpy.newaxis]
+		dot = QV + i * MV
+		norm2 = QQ + 2 * i * QM + i * i * MM
+		if length2 > 0:
+			t = numpy.clip(dot / length2, 0, 1)
+			norm2 = norm2 - 2 * t * dot + t * t * length2
+		distance[start:start+step] = numpy.sqrt(numpy.maximum(norm2, 0))
+	return distance
+
+def box_empty(box):
+	return any(s.stop <= s.start for s in box)
+
+def box_intersect(a, b):
+	return tuple(slice(max(s.start, t.start), max(min(s.stop, t.stop), s.start, t.start)) for s, t in zip(a, b))
+
+def box_union(boxes):
+	boxes = [box for box in boxes if not box_empty(box)]
+	if not boxes:
+		return None
+	return tuple(
+		slice(min(box[d].start for box in boxes), max(box[d].stop for box in boxes))
+		for d in range(len(boxes[0]))
+	)
+
+def box_relative(box, outer):
+	return tuple(slice(s.start - o.start, s.stop - o.start) for s, o in zip(box, outer))
+
+def mask_box(mask):
+	box = []
+	for axis in range(mask.ndim):
+		I = numpy.flatnonzero(numpy.any(mask, axis=tuple(d for d in range(mask.ndim) if d != axis)))
+		if I.size == 0:
+			return tuple(slice(0, 0) for _ in mask.shape)
+		box.append(slice(int(I[0]), int(I[-1]) + 1))
+	return tuple(box)
+
+def mask_index(data):
+	mask = numpy.asarray(data) != 0
+	box = mask_box(mask)
+	return {
+		'count': numpy.count_nonzero(mask[box]),
+		'box': box,
+		'mask': mask[box],
+		'covered': 0,
+	}
+
+def mask_overlap(index, box, array):
+	box = box_intersect(index['box'], box)
+	if box_empty(box):
+		return 0
+	return numpy.count_nonzero(index['mask'][box_relative(box, index['box'])] & (array[box] > 0))
+
+def mask_field(data, zooms, unit_factor):
+	import scipy.ndimage # deferred until the first avoid mask
+	mask = numpy.asarray(data) != 0
+	if not mask.any():
+		return numpy.full(mask.shape, numpy.inf, dtype=numpy.float32)
+	field = scipy.ndimage.distance_transform_edt(~mask, zooms)
+	field *= unit_factor
+	return field.astype(numpy.float32)
+
+def segment_clearance(entry_xyz, target_xyz, world2vox, zooms, field):
+	import scipy.ndimage
+	entry_xyz = numpy.asarray(entry_xyz, dtype=float)
+	vector_xyz = numpy.asarray(target_xyz, dtype=float) - entry_xyz
+	num = math.ceil(2 * numpy.linalg.norm(vector_xyz) / min(zooms)) + 1
+	t = numpy.linspace(0, 1, num)[:, numpy.newaxis]
+	points_ijk = (entry_xyz + t * vector_xyz) @ world2vox[:3, :3].T + world2vox[:3, 3]
+	values = scipy.ndimage.map_coordinates(field, points_ijk.T, order=1, mode='nearest')
+	return float(values.min())
+
+def trajectory(entry_xyz, target_xyz, world2vox, steps=None):
+	# evenly spaced, or at every crossing of a voxel-centre plane when steps is none
+	entry_xyz = numpy.asarray(entry_xyz, dtype=float)
+	vector_xyz = numpy.asarray(target_xyz, dtype=float) - entry_xyz
+	if steps is not None:
+		t = numpy.linspace(0, 1, steps + 1)
+	else:
+		entry_ijk = world2vox[:3, :3] @ entry_xyz + world2vox[:3, 3]
+		vector_ijk = world2vox[:3, :3] @ vector_xyz
+		t = [numpy.array([0., 1.])]
+		for a in range(3):
+			if vector_ijk[a] == 0:
+				continue
+			lo, hi = sorted([entry_ijk[a], entry_ijk[a] + vector_ijk[a]])
+			planes = numpy.arange(math.ceil(lo), math.floor(hi) + 1)
+			t.append((planes - entry_ijk[a]) / vector_ijk[a])
+		t = numpy.unique(numpy.clip(numpy.concatenate(t), 0, 1))
+	return t, entry_xyz + t[:, numpy.newaxis] * vector_xyz
+
+def segment_distances(p0, p1, q0, q1):
+	# closest distance of segments p0p1 and q0q1 in closed form, broadcast over leading axes
+	d1 = p1 - p0
+	d2 = q1 - q0
+	r = p0 - q0
+	a = numpy.sum(d1 * d1, axis=-1)
+	b = numpy.sum(d1 * d2, axis=-1)
+	c = numpy.sum(d1 * r, axis=-1)
+	e = numpy.sum(d2 * d2, axis=-1)
+	f = numpy.sum(d2 * r, axis=-1)
+	eps = 1e-12
+	a_safe = numpy.maximum(a, eps)
+	e_safe = numpy.maximum(e, eps)
+	denom = a * e - b * b
+	parallel = denom <= eps * a_safe * e_safe
+	s = numpy.where(parallel, 0., numpy.clip((b * f - c * e) / numpy.where(parallel, 1., denom), 0., 1.))
+	t = (b * s + f) / e_safe
+	s = numpy.where(t < 0., numpy.clip(-c / a_safe, 0., 1.), numpy.where(t > 1., numpy.clip((b - c) / a_safe, 0., 1.), s))
+	t = numpy.clip(t, 0., 1.)
+	# segments reduced to points
+	s = numpy.where(e <= eps, numpy.clip(-c / a_safe, 0., 1.), s)
+	t = numpy.where(e <= eps, 0., t)
+	s = numpy.where(a <= eps, 0., s)
+	t = numpy.where(a <= eps, numpy.where(e <= eps, 0., numpy.clip(f / e_safe, 0., 1.)), t)
+	return numpy.linalg.norm(r + s[..., numpy.newaxis] * d1 - t[..., numpy.newaxis] * d2, axis=-1)
+
+def point_distances(points, p0, p1):
+	# distance of points (m, 3) from segments p0p1 (k, 3), as a (k, m) array of matrix products
+	d = p1 - p0
+	dd = numpy.maximum(numpy.sum(d * d, axis=-1), 1e-12)[:, numpy.newaxis]
+	wd = d @ points.T - numpy.sum(p0 * d, axis=-1)[:, numpy.newaxis]
+	ww = numpy.sum(points * points, axis=-1) - 2 * p0 @ points.T + numpy.sum(p0 * p0, axis=-1)[:, numpy.newaxis]
+	s = numpy.clip(wd / dd, 0., 1.)
+	return numpy.sqrt(numpy.maximum(ww - s * (2 * wd - s * dd), 0.))
+
+def sphere_directions(count):
+	# nearly uniform unit vectors on a fibonacci spiral
+	k = numpy.arange(count) + .5
+	z = 1 - 2 * k / count
+	r = numpy.sqrt(1 - z * z)
+	phi = math.pi * (3 - math.sqrt(5)) * k
+	return numpy.stack([r * numpy.cos(phi), r * numpy.sin(phi), z], axis=-1)
+
+def voxels_mask(voxels, box):
+	L = numpy.asarray([s.start for s in box])
+	U = numpy.asarray([s.stop for s in box])
+	mask = numpy.zeros(U - L, dtype=bool)
+	mask[tuple((voxels - L).T)] = True
+	return mask
+
+def bundle_save(path, plan, grid, rasters):
+	# plan as in json files, grid as Engine.grid, rasters as (needle, diameter, safezone, raster)
+	shape, pixdim, vox2world, unit_factor = grid
+	arrays = {
+		'version': numpy.array(BUNDLE_VERSION),
+		'plan': numpy.array(json.dumps(plan)),
+		'shape': numpy.array(shape),
+		'pixdim': numpy.array(pixdim),
+		'vox2world': numpy.reshape(vox2world, (4, 4)),
+		'unit_factor': numpy.array(unit_factor),
+	}
+	for i, (needle, diameter, safezone, raster) in enumerate(rasters):
+		prefix = 'raster{:d}_'.format(i)
+		arrays[prefix + 'needle'] = numpy.array([needle['entry'], needle['target']], dtype=float)
+		arrays[prefix + 'geometry'] = numpy.array([diameter, safezone])
+		arrays[prefix + 'box'] = numpy.array([[s.start, s.stop] for s in raster['box']])
+		for which in ['shell', 'zone', 'core']:
+			arrays[prefix + which] = raster[which]
+	with open(path, 'wb') as fp:
+		numpy.savez_compressed(fp, **arrays)
+
+def bundle_load(path):
+	with numpy.load(path, allow_pickle=False) as npz:
+		assert int(npz['version']) == BUNDLE_VERSION
+		plan = json.loads(str(npz['plan']))
+		plan_check(plan)
+		grid = (
+			tuple(int(x) for x in npz['shape']),
+			tuple(float(x) for x in npz['pixdim']),
+			tuple(float(x) for x in numpy.ravel(npz['vox2world'])),
+			float(npz['unit_factor']),
+		)
+		rasters = []
+		i = 0
+		while 'raster{:d}_needle'.format(i) in npz.files:
+			prefix = 'raster{:d}_'.format(i)
+			entry, target = npz[prefix + 'needle']
+			diameter, safezone = (int(x) for x in npz[prefix + 'geometry'])
+			raster = {
+				'box': tuple(slice(int(start), int(stop)) for start, stop in npz[prefix + 'box']),
+			}
+			for which in ['shell', 'zone', 'core']:
+				raster[which] = npz[prefix + which]
+				assert raster[which].dtype == bool
+				assert raster[which].shape == tuple(s.stop - s.start for s in raster['box'])
+			needle = {
+				'entry': tuple(float(x) for x in entry),
+				'target': tuple(float(x) for x in target),
+			}
+			rasters.append((needle, diameter, safezone, raster))
+			i += 1
+	return plan, grid, rasters
+
+
+
+"""
+
+needle : dict
+	entry : tuple of float
+	target : tuple of float
+
+slot : (needle, int, bool)
+	needle, label index, whether the needle counts in metrics
+
+self.shape : tuple of int
+self.pixdim : tuple of float
+self.vox2world : ndarray
+self.world2vox : ndarray
+self.unit_factor : float
+self.grid : tuple
+self.lock : lock
+self.pool : threadpoolexecutor
+self.cache : dict
+	(entry, target, diameter, safezone, drawmode, grid) : dict
+		box : tuple of slice
+		line : ndarray|none
+		shell : ndarray|none
+		zone : ndarray|none
+		core : ndarray|none
+self.fields : dict
+	(entry, target, grid) : dict
+		box : tuple of slice
+		radius : float
+			in mm, the largest threshold the distances are valid for
+		distance : ndarray
+self.drawn : tuple[]
+self.draw_array : ndarray|none
+self.draw_buffer : ndarray
+self.label_array : ndarray|none
+self.targets : dict[]
+	count : int
+	box : tuple of slice
+	mask : ndarray
+	covered : int
+self.segments : ndarray
+	entry and target of the needles of the last needle_distances call
+self.distances : ndarray
+	axis distances of those needles in mm, infinite on the diagonal
+self.avoids : dict[]
+	count : int
+	box : tuple of slice
+	mask : ndarray
+	field : ndarray
+		distance to the mask in mm
+self.profile : bool
+	whether rasterize reports stage timings in seconds
+self.retained : dict
+	(entry, target, diameter, safezone, drawmode, grid) : dict
+		rasters kept outside the cache, e.g. by undo states
+self.mask_cache : maskcache|none
+
+"""
+
+
+class Engine:
+
+	def __init__(self, shape, pixdim, vox2world, xyz_units=2, workers=DRAW_WORKERS, mask_cache=None):
+		self.shape = tuple(int(x) for x in shape)
+		self.pixdim = tuple(float(x) for x in pixdim[:len(self.shape)])
+		self.vox2world = numpy.asarray(vox2world, dtype=float)
+		self.world2vox = numpy.linalg.inv(self.vox2world)
+		self.unit_factor = UNIT_FACTORS.get(xyz_units, 1e0)
+		self.grid = (
+			self.shape,
+			self.pixdim,
+			tuple(numpy.ravel(self.vox2world)),
+			self.unit_factor,
+		)
+		self.lock = threading.Lock()
+		self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+		self.cache = {}
+		self.fields = {}
+		self.drawn = []
+		self.draw_array = None
+		self.draw_buffer = numpy.empty(0, dtype=LABEL_DTYPE)
+		self.label_array = None
+		self.targets = []
+		self.segments = numpy.empty((0, 2, 3))
+		self.distances = numpy.empty((0, 0))
+		self.avoids = []
+		self.profile = False
+		self.retained = {}
+		self.mask_cache = mask_cache
+
+	def close(self):
+		self.pool.shutdown(wait=False, cancel_futures=True)
+
+	def grid_match(self, grid):
+		shape, pixdim, vox2world, unit_factor = grid
+		return tuple(shape) == self.shape \
+			and numpy.allclose(numpy.reshape(vox2world, (4, 4)), self.vox2world) \
+			and unit_factor == self.unit_factor
+
+	def bundle_rasters(self, needles, diameter, safezone):
+		# full rasters of needles for a bundle, reusing drawn ones
+		rasters = []
+		for needle in needles:
+			key = self.needle_key(needle, 'full', diameter, safezone)
+			raster = self.cache.get(key) or self.retained.get(key)
+			if raster is None:
+				raster = self.needle_raster(needle, 'full', diameter, safezone)
+			rasters.append((needle, diameter, safezone, raster))
+		return rasters
+
+	def bundle_seeds(self, grid, rasters):
+		# rasters of a bundle keyed for this engine, none unless the grids match
+		if not self.grid_match(grid):
+			return None
+		return {
+			self.needle_key(needle, 'full', diameter, safezone): raster
+			for needle, diameter, safezone, raster in rasters
+		}
+
+	def needle_key(self, needle, drawmode, diameter, safezone):
+		if drawmode != 'full':
+			diameter = None
+			safezone = None
+		return (
+			tuple(needle['entry']),
+			tuple(needle['target']),
+			diameter,
+			safezone,
+			drawmode,
+			self.grid,
+		)
+
+	def field_key(self, needle):
+		return (
+			tuple(needle['entry']),
+			tuple(needle['target']),
+			self.grid,
+		)
+
+	def needle_field(self, needle, radius, timings=None):
+		# distances out to radius mm; an outgrown field at least doubles, so that steps up reuse it
+		key = self.field_key(needle)
+		field = self.fields.get(key)
+		if field is not None and field['radius'] >= radius:
+			return field
+		if field is not None:
+			radius = max(radius, min(2 * field['radius'], GEOMETRY_SAFEZONE_MAX))
+		box = capsule_box(
+			needle['entry'],
+			needle['target'],
+			self.world2vox,
+			self.shape,
+			radius / self.unit_factor,
+		)
+		with timer(timings, 'field'):
+			distance = capsule_distance(
+				needle['entry'],
+				needle['target'],
+				self.vox2world,
+				box,
+			)
+			distance *= self.unit_factor
+		field = {
+			'box': box,
+			'radius': radius,
+			'distance': distance,
+		}
+		self.fields[key] = field
+		return field
+
+	def needle_raster(self, needle, drawmode, diameter, safezone, timings=None):
+		assert drawmode in ['line', 'full']
+		if drawmode == 'line':
+			with timer(timings, 'line'):
+				voxels = pair2voxels(
+					needle['entry'],
+					needle['target'],
+					self.world2vox,
+					self.pixdim,
+					self.shape,
+				)
+				box = voxels_box(voxels, self.shape)
+				line = voxels_mask(voxels, box)
+			return {
+				'box': box,
+				'line': line,
+			}
+		radius = max(diameter / 2, safezone)
+		field = self.needle_field(needle, radius, timings)
+		with timer(timings, 'threshold'):
+			box = capsule_box(
+				needle['entry'],
+				needle['target'],
+				self.world2vox,
+				self.shape,
+				radius / self.unit_factor,
+			)
+			mask = field['distance'][box_relative(box, field['box'])]
+			sz1 = mask > safezone - GEOMETRY_BORDER
+			sz2 = mask <= safezone
+			dm2 = mask <= diameter / 2
+		return {
+			'box': box,
+			'shell': sz1 * sz2,
+			'zone': sz2,
+			'core': dm2,
+		}
+
+	def rasterize(self, slots, drawmode, diameter, safezone, cancelled=None):
+		timings = {} if self.profile else None
+		start = time.perf_counter()
+		retained = self.retained
+		missing = {}
+		for needle, index, draw_pass in slots:
+			key = self.needle_key(needle, drawmode, diameter, safezone)
+			if key not in self.cache and key not in retained and key not in missing:
+				missing[key] = self.pool.submit(self.needle_raster, needle, drawmode, diameter, safezone, timings)
+		pending = set(missing.values())
+		while pending:
+			if cancelled is not None and cancelled():
+				for future in pending:
+					future.cancel()
+				self.cache.update({
+					key: future.result()
+					for key, future in missing.items()
+					if future.done() and not future.cancelled() and future.exception() is None
+				})
+				return None
+			_, pending = concurrent.futures.wait(pending, timeout=.05)
+		if timings is not None:
+			timings['raster'] = time.perf_counter() - start
+		drawn = []
+		cache = {}
+		for needle, index, draw_pass in slots:
+			key = self.needle_key(needle, drawmode, diameter, safezone)
+			if key in missing:
+				raster = missing[key].result()
+			elif key in self.cache:
+				raster = self.cache[key]
+			else:
+				raster = retained[key]
+			cache[key] = raster
+			drawn.append((key, index, draw_pass, raster))
+		if drawmode != 'none':
+			self.cache = cache
+		if drawmode == 'full':
+			keys = set(self.field_key(needle) for needle, _, _ in slots)
+			self.fields = {
+				key: field
+				for key, field in self.fields.items()
+				if key in keys
+			}
+		with timer(timings, 'merge'), self.lock:
+			if drawmode != 'none':
+				dtype = numpy.min_scalar_type(len(slots))
+				if self.draw_array is None:
+					self.draw_array = numpy.zeros(self.shape, dtype=dtype)
+				elif numpy.iinfo(self.draw_array.dtype).max < len(slots):
+					self.draw_array = self.draw_array.astype(dtype)
+			signatures = set(slot[:3] for slot in drawn)
+			previous = set(slot[:3] for slot in self.drawn)
+			region = box_union(
+				[slot[3]['box'] for slot in drawn if slot[:3] not in previous] +
+				[slot[3]['box'] for slot in self.drawn if slot[:3] not in signatures]
+			)
+			data = None
+			if region is not None:
+				shape = tuple(s.stop - s.start for s in region)
+				size = math.prod(shape)
+				if self.draw_buffer.size < size:
+					self.draw_buffer = numpy.empty(size, dtype=LABEL_DTYPE)
+				data = self.draw_buffer[:size].reshape(shape)
+				data.fill(0)
+				if self.draw_array is not None:
+					for target in self.targets:
+						target['covered'] -= mask_overlap(target, region, self.draw_array)
+					self.draw_array[region] = 0
+				for key, index, draw_pass, raster in drawn:
+					box = box_intersect(raster['box'], region)
+					if box_empty(box):
+						continue
+					src = box_relative(box, raster['box'])
+					dst = box_relative(box, region)
+					if drawmode == 'line':
+						data[dst][raster['line'][src]] = index
+						if draw_pass:
+							self.draw_array[box][raster['line'][src]] = index
+					elif drawmode == 'full':
+						data[dst][raster['shell'][src]] = 10 * index + 1
+						data[dst][raster['core'][src]] = 10 * index
+						if draw_pass:
+							self.draw_array[box][raster['zone'][src]] = index
+				if self.draw_array is not None:
+					for target in self.targets:
+						target['covered'] += mask_overlap(target, region, self.draw_array)
+			self.drawn = drawn
+		return {
+			'region': region,
+			'data': data,
+			'timings': timings,
+		}
+
+	def labels(self, needles, drawmode='full', diameter=GEOMETRY_DIAMETER_DEF, safezone=GEOMETRY_SAFEZONE_DEF):
+		assert drawmode in ['none', 'line', 'full']
+		slots = []
+		if drawmode != 'none':
+			slots = [
+				(needle, i + 1, True)
+				for i, needle in enumerate(needles)
+			]
+		result = self.rasterize(slots, drawmode, diameter, safezone)
+		if self.label_array is None:
+			self.label_array = numpy.zeros(self.shape, dtype=LABEL_DTYPE)
+		if result['region'] is not None:
+			self.label_array[result['region']] = result['data']
+		return self.label_array
+
+	def mask_indexed(self, data):
+		# index of a mask, from the mask cache when possible
+		key = None
+		if self.mask_cache is not None:
+			key = self.mask_cache.key(data, self.grid)
+			box = self.mask_cache.load(key, 'index-box')
+			mask = self.mask_cache.load(key, 'index-mask')
+			if box is not None and mask is not None:
+				return key, {
+					'count': numpy.count_nonzero(mask),
+					'box': tuple(slice(int(start), int(stop)) for start, stop in box),
+					'mask': mask,
+				}
+		index = mask_index(data)
+		if self.mask_cache is not None:
+			self.mask_cache.save(key, 'index-box', numpy.array([[s.start, s.stop] for s in index['box']]))
+			self.mask_cache.save(key, 'index-mask', index['mask'])
+		return key, index
+
+	def target_insert(self, data):
+		_, target = self.mask_indexed(data)
+		target['covered'] = 0
+		with self.lock:
+			if self.draw_array is not None:
+				target['covered'] = mask_overlap(target, target['box'], self.draw_array)
+			self.targets.append(target)
+		return target
+
+	def target_remove(self, i):
+		with self.lock:
+			self.targets.pop(i)
+
+	def target_coverage(self, i):
+		with self.lock:
+			target = self.targets[i]
+			if self.draw_array is None or target['count'] == 0:
+				return None
+			return float(target['covered'] / target['count'])
+
+	def target_needles(self, i):
+		# target voxels covered by each drawn needle, alone or together with others
+		with self.lock:
+			target = self.targets[i]
+			slots = [
+				(index, raster, box_intersect(raster['box'], target['box']))
+				for _, index, draw_pass, raster in self.drawn
+				if draw_pass
+			]
+			slots = [slot for slot in slots if not box_empty(slot[2])]
+			region = box_union([box for _, _, box in slots])
+			if region is None:
+				return []
+			shape = tuple(s.stop - s.start for s in region)
+			count = numpy.zeros(shape, dtype=LABEL_DTYPE)
+			owner = numpy.zeros(shape, dtype=LABEL_DTYPE)
+			covered = {}
+			for index, raster, box in slots:
+				zone = raster['zone'] if 'zone' in raster else raster['line']
+				hit = zone[box_relative(box, raster['box'])] & target['mask'][box_relative(box, target['box'])]
+				dst = box_relative(box, region)
+				count[dst] += hit
+				owner[dst][hit] = index
+				covered[index] = covered.get(index, 0) + int(numpy.count_nonzero(hit))
+		unique = numpy.bincount(owner[count == 1], minlength=max(covered) + 1)
+		return [
+			{
+				'needle': index,
+				'covered': voxels,
+				'unique': int(unique[index]),
+				'shared': voxels - int(unique[index]),
+			}
+			for index, voxels in covered.items()
+			if voxels > 0
+		]
+
+	def avoid_insert(self, data):
+		key, avoid = self.mask_indexed(data)
+		field = None
+		if key is not None:
+			field = self.mask_cache.load(key, 'avoid-field')
+		if field is None:
+			field = mask_field(data, self.pixdim, self.unit_factor)
+			if key is not None:
+				self.mask_cache.save(key, 'avoid-field', field)
+		avoid['field'] = field
+		self.avoids.append(avoid)
+		return avoid
+
+	def avoid_remove(self, i):
+		self.avoids.pop(i)
+
+	def avoid_clearances(self, i, needles):
+		return [
+			(index, segment_clearance(
+				needle['entry'],
+				needle['target'],
+				self.world2vox,
+				self.pixdim,
+				self.avoids[i]['field'],
+			))
+			for index, needle in needles
+		]
+
+	def avoid_report(self, i, needles, safezone=GEOMETRY_SAFEZONE_DEF):
+		# drawn voxels of each needle inside avoid i, counted within its box only
+		avoid = self.avoids[i]
+		inside = {}
+		with self.lock:
+			for key, _, draw_pass, raster in self.drawn:
+				box = box_intersect(raster['box'], avoid['box'])
+				if not draw_pass or box_empty(box):
+					continue
+				zone = raster['zone'] if 'zone' in raster else raster['line']
+				hit = zone[box_relative(box, raster['box'])] & avoid['mask'][box_relative(box, avoid['box'])]
+				inside[key[:2]] = int(numpy.count_nonzero(hit))
+		volume = math.prod(self.pixdim) * self.unit_factor ** 3
+		report = []
+		for (index, needle), (_, clearance) in zip(needles, self.avoid_clearances(i, needles)):
+			voxels = inside.get((tuple(needle['entry']), tuple(needle['target'])), 0)
+			report.append({
+				'needle': index,
+				'clearance': clearance,
+				'violation': clearance <= safezone,
+				'voxels': voxels,
+				'volume': voxels * volume,
+			})
+		return report
+
+	def needle_distances(self, needles):
+		# pairwise axis distances in mm, computing only the rows of needles not seen in the last call
+		segments = numpy.array([
+			[needle['entry'], needle['target']]
+			for needle in needles
+		], dtype=float).reshape(-1, 2, 3)
+		previous = {}
+		for k, segment in enumerate(self.segments):
+			previous.setdefault(segment.tobytes(), k)
+		source = []
+		for segment in segments:
+			k = previous.pop(segment.tobytes(), -1) # a duplicate is a new row
+			source.append(k)
+		source = numpy.array(source, dtype=int)
+		known = numpy.flatnonzero(source >= 0)
+		fresh = numpy.flatnonzero(source < 0)
+		distances = numpy.empty((len(segments), len(segments)))
+		distances[numpy.ix_(known, known)] = self.distances[numpy.ix_(source[known], source[known])]
+		if fresh.size:
+			rows = segment_distances(
+				segments[fresh, numpy.newaxis, 0],
+				segments[fresh, numpy.newaxis, 1],
+				segments[numpy.newaxis, :, 0],
+				segments[numpy.newaxis, :, 1],
+			) * self.unit_factor
+			distances[fresh, :] = rows
+			distances[:, fresh] = rows.T
+		numpy.fill_diagonal(distances, numpy.inf)
+		self.segments = segments
+		self.distances = distances
+		return distances
+
+	def needle_contacts(self, needles, diameter=GEOMETRY_DIAMETER_DEF, margin=NEEDLE_MARGIN):
+		# pairs of needles closer than the diameter plus a margin, numbered from 1
+		distances = self.needle_distances(needles)
+		return [
+			{
+				'needles': (int(i) + 1, int(j) + 1),
+				'distance': float(distances[i, j]),
+			}
+			for i, j in numpy.argwhere(numpy.triu(distances < diameter + margin, 1))
+		]
+
+	def optimize(self, i, count, needles=(), diameter=GEOMETRY_DIAMETER_DEF, safezone=GEOMETRY_SAFEZONE_DEF, margin=NEEDLE_MARGIN, cancelled=None, timings=None, seed=0):
+		# greedy trajectories covering target i, entering at the volume border; none when cancelled
+		import scipy.ndimage
+		with self.lock:
+			target = self.targets[i]
+			avoids = list(self.avoids)
+		rng = numpy.random.default_rng(seed)
+		vox2world = self.vox2world[:3, :3], self.vox2world[:3, 3]
+		world2vox = self.world2vox[:3, :3], self.world2vox[:3, 3]
+		with timer(timings, 'candidates'):
+			voxels = numpy.argwhere(target['mask']) + [s.start for s in target['box']]
+			voxels = voxels[rng.permutation(len(voxels))[:OPTIMIZER_SAMPLES]]
+			samples = voxels @ vox2world[0].T + vox2world[1]
+			tips = samples[:OPTIMIZER_TIPS]
+			# every direction leaves the grid through the nearest face
+			directions = sphere_directions(OPTIMIZER_DIRECTIONS)
+			tips_ijk = voxels[:OPTIMIZER_TIPS, numpy.newaxis].astype(float)
+			directions_ijk = (directions @ world2vox[0].T)[numpy.newaxis]
+			bound = numpy.where(directions_ijk > 0, numpy.array(self.shape) - 1., 0.)
+			with numpy.errstate(divide='ignore', invalid='ignore'):
+				steps = numpy.where(directions_ijk != 0, (bound - tips_ijk) / directions_ijk, numpy.inf)
+			steps = steps.min(axis=-1)
+			p1 = numpy.repeat(tips, len(directions), axis=0)
+			p0 = p1 + (steps[..., numpy.newaxis] * directions).reshape(-1, 3)
+			lengths = numpy.linalg.norm(p1 - p0, axis=-1) * self.unit_factor
+		with timer(timings, 'clearance'):
+			feasible = lengths > 0
+			t = numpy.linspace(0., 1., OPTIMIZER_POINTS)[:, numpy.newaxis]
+			for start in range(0, len(p0), OPTIMIZER_CHUNK):
+				if cancelled is not None and cancelled():
+					return None
+				chunk = slice(start, start + OPTIMIZER_CHUNK)
+				points = p0[chunk, numpy.newaxis] + t * (p1[chunk] - p0[chunk])[:, numpy.newaxis]
+				points_ijk = points.reshape(-1, 3) @ world2vox[0].T + world2vox[1]
+				for avoid in avoids:
+					values = scipy.ndimage.map_coordinates(avoid['field'], points_ijk.T, order=1, mode='nearest')
+					feasible[chunk] &= values.reshape(-1, OPTIMIZER_POINTS).min(axis=-1) > safezone
+			candidates = numpy.flatnonzero(feasible)
+		with timer(timings, 'coverage'):
+			cover = numpy.zeros((len(candidates), len(samples)), dtype=bool)
+			for start in range(0, len(candidates), OPTIMIZER_CHUNK):
+				if cancelled is not None and cancelled():
+					return None
+				chunk = candidates[start:start + OPTIMIZER_CHUNK]
+				cover[start:start + len(chunk)] = point_distances(samples, p0[chunk], p1[chunk]) * self.unit_factor <= safezone
+			covered = numpy.zeros(len(samples), dtype=bool)
+			chosen = [
+				(numpy.asarray(needle['entry'], dtype=float), numpy.asarray(needle['target'], dtype=float))
+				for needle in needles
+			]
+			for entry, tip in chosen:
+				covered |= point_distances(samples, entry[numpy.newaxis], tip[numpy.newaxis])[0] * self.unit_factor <= safezone
+		with timer(timings, 'select'):
+			excluded = numpy.zeros(len(candidates), dtype=bool)
+			for entry, tip in chosen:
+				excluded |= segment_distances(p0[candidates], p1[candidates], entry, tip) * self.unit_factor < diameter + margin
+			proposals = []
+			gains = numpy.count_nonzero(cover[:, ~covered], axis=-1)
+			while len(proposals) < count:
+				if cancelled is not None and cancelled():
+					return None
+				if not numpy.any(gains[~excluded] > 0):
+					break
+				# the shortest among the best, checked exactly against the avoid masks
+				best = numpy.lexsort((lengths[candidates], -numpy.where(excluded, -1, gains)))[0]
+				k = candidates[best]
+				excluded[best] = True
+				if any(
+					segment_clearance(p0[k], p1[k], self.world2vox, self.pixdim, avoid['field']) <= safezone
+					for avoid in avoids
+				):
+					continue
+				proposals.append({
+					'entry': tuple(float(x) for x in p0[k]),
+					'target': tuple(float(x) for x in p1[k]),
+				})
+				fresh = cover[best] & ~covered
+				gains -= numpy.count_nonzero(cover[:, fresh], axis=-1)
+				covered |= fresh
+				excluded |= segment_distances(p0[candidates], p1[candidates], p0[k], p1[k]) * self.unit_factor < diameter + margin
+		return {
+			'needles': proposals,
+			'candidates': len(p0),
+			'coverage': float(covered.mean()) if covered.size else None,
+		}
+
+	def metrics(self, needles, safezone=GEOMETRY_SAFEZONE_DEF):
+		needles = [
+			(i + 1, needle)
+			for i, needle in enumerate(needles)
+		]
+		return {
+			'targets': [self.target_coverage(i) for i in range(len(self.targets))],
+			'target_needles': [self.target_needles(i) for i in range(len(self.targets))],
+			'avoids': [self.avoid_report(i, needles, safezone) for i in range(len(self.avoids))],
+		}
+
+
+
+"""
+
+state : dict
+	needles : dict[]
+	rasters : dict
+		(entry, target, diameter, safezone, drawmode, grid) : dict
+	used : int
+
+self.budget : int
+self.clock : int
+self.states : state[]
+self.position : int
+
+"""
+
+
+class History:
+
+	def __init__(self, needles, budget=HISTORY_BUDGET, rasters=None):
+		self.budget = budget
+		self.clock = 0
+		self.states = [self.state(needles)]
+		self.position = 0
+		if rasters is not None:
+			# e.g. seeds of a bundle, kept like the rasters of a left state
+			self.states[0]['rasters'] = dict(rasters)
+
+	@staticmethod
+	def state(needles):
+		return {
+			'needles': [dict(needle) for needle in needles],
+			'rasters': {},
+			'used': 0,
+		}
+
+	def leave(self, rasters):
+		# rasters are the engine cache, drawn for the state being left
+		self.clock += 1
+		state = self.states[self.position]
+		state['rasters'] = {**state['rasters'], **rasters}
+		state['used'] = self.clock
+
+	def push(self, needles, rasters):
+		self.leave(rasters)
+		del self.states[self.position + 1:]
+		self.states.append(self.state(needles))
+		self.position += 1
+		self.evict()
+
+	def can_undo(self):
+		return self.position > 0
+
+	def can_redo(self):
+		return self.position < len(self.states) - 1
+
+	def undo(self, rasters):
+		assert self.can_undo()
+		self.leave(rasters)
+		self.position -= 1
+		self.evict()
+		return [dict(needle) for needle in self.states[self.position]['needles']]
+
+	def redo(self, rasters):
+		assert self.can_redo()
+		self.leave(rasters)
+		self.position += 1
+		self.evict()
+		return [dict(needle) for needle in self.states[self.position]['needles']]
+
+	def rasters(self):
+		rasters = {}
+		for state in self.states:
+			rasters.update(state['rasters'])
+		return rasters
+
+	def nbytes(self):
+		# states share rasters, so every raster is counted once
+		rasters = {
+			id(raster): raster
+			for state in self.states
+			for raster in state['rasters'].values()
+		}
+		return sum(
+			array.nbytes
+			for raster in rasters.values()
+			for array in raster.values()
+			if isinstance(array, numpy.ndarray)
+		)
+
+	def evict(self):
+		while self.nbytes() > self.budget:
+			states = [
+				state
+				for i, state in enumerate(self.states)
+				if state['rasters'] and i != self.position
+			]
+			if not states:
+				break
+			min(states, key=lambda state: state['used'])['rasters'] = {}
+
+
+
+"""
+
+self.directory : str
+self.limit : int
+
+Files are named after the key and the derived array, loaded memory-mapped
+and evicted by modification time, which every load refreshes.
+
+"""
+
+
+class MaskCache:
+
+	def __init__(self, directory, limit=MASK_CACHE_LIMIT):
+		self.directory = directory
+		self.limit = limit
+
+	@staticmethod
+	def key(data, grid):
+		shape, pixdim, vox2world, unit_factor = grid
+		data = numpy.ascontiguousarray(data)
+		digest = hashlib.sha256()
+		digest.update(str(data.dtype).encode())
+		digest.update(numpy.asarray(data.shape, dtype=numpy.int64).tobytes())
+		digest.update(numpy.asarray(shape, dtype=numpy.int64).tobytes())
+		digest.update(numpy.asarray(pixdim, dtype=float).tobytes())
+		digest.update(numpy.asarray(vox2world, dtype=float).tobytes())
+		digest.update(numpy.asarray(unit_factor, dtype=float).tobytes())
+		digest.update(data.view(numpy.uint8) if data.size else b'')
+		return digest.hexdigest()
+
+	def path(self, key, name):
+		return os.path.join(self.directory, '{:s}-{:s}.npy'.format(key, name))
+
+	def load(self, key, name):
+		path = self.path(key, name)
+		try:
+			array = numpy.load(path, mmap_mode='r', allow_pickle=False)
+			os.utime(path)
+		except (OSError, ValueError):
+			return None
+		return array
+
+	def save(self, key, name, array):
+		path = self.path(key, name)
+		temp = '{:s}.{:d}.tmp'.format(path, os.getpid())
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			with open(temp, 'wb') as fp:
+				numpy.save(fp, array, allow_pickle=False)
+			os.replace(temp, path)
+			self.evict()
+		except OSError:
+			with contextlib.suppress(OSError):
+				os.remove(temp)
+
+	def evict(self):
+		files = []
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith('.npy'):
+				stat = entry.stat()
+				files.append((stat.st_mtime, stat.st_size, entry.path))
+		size = sum(item[1] for item in files)
+		for _, nbytes, path in sorted(files):
+			if size <= self.limit:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			size -= nbytes
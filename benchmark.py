@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy
+import scipy
+
+import ablation
+
+
+"""
+
+document : dict
+	meta : dict
+		version : str|none
+		python : str
+		numpy : str
+		scipy : str
+		machine : str
+		cpus : int
+		workers : int
+		needles : int
+		repeat : int
+		seed : int
+	results : dict[]
+		stage : str
+		shape : int[]
+		pixdim : float[]
+		times : float[]
+		min : float
+		median : float
+
+Times are in seconds per stage for the whole needle set.
+
+"""
+
+
+SIZES = [128, 256, 512]
+
+PIXDIMS = {
+	'iso': (1., 1., 1.),
+	'aniso': (.5, .5, 2.),
+}
+
+
+def version():
+	try:
+		return subprocess.run(
+			['git', 'describe', '--always', '--dirty'],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			capture_output=True,
+			text=True,
+			check=True,
+		).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def synthetic_grid(size, pixdim):
+	shape = (size, size, size)
+	vox2world = numpy.diag(pixdim + (1.,))
+	return shape, vox2world
+
+def synthetic_masks(shape, pixdim):
+	ijk = numpy.ogrid[tuple(slice(0, s) for s in shape)]
+	xyz = [(i - s / 2) * p for i, s, p in zip(ijk, shape, pixdim)]
+	extent = min(s * p for s, p in zip(shape, pixdim))
+	# spherical target at the centre and a vessel-like tube beside it
+	target = xyz[0] ** 2 + xyz[1] ** 2 + xyz[2] ** 2 <= (extent / 8) ** 2
+	avoid = (xyz[0] - extent / 4) ** 2 + xyz[1] ** 2 <= (extent / 32) ** 2
+	avoid = numpy.broadcast_to(avoid, shape)
+	return target, avoid
+
+def synthetic_needles(shape, pixdim, count, rng):
+	centre = numpy.array([s * p / 2 for s, p in zip(shape, pixdim)])
+	extent = min(s * p for s, p in zip(shape, pixdim))
+	needles = []
+	for _ in range(count):
+		target = centre + rng.uniform(-extent / 8, extent / 8, 3)
+		direction = rng.normal(size=3)
+		direction /= numpy.linalg.norm(direction)
+		entry = target + direction * rng.uniform(extent / 4, extent / 2)
+		needles.append({
+			'entry': tuple(float(x) for x in entry),
+			'target': tuple(float(x) for x in target),
+		})
+	return needles
+
+def measure(function, repeat, setup=None, teardown=None):
+	times = []
+	for _ in range(repeat):
+		state = setup() if setup is not None else None
+		start = time.perf_counter()
+		function(state)
+		times.append(time.perf_counter() - start)
+		if teardown is not None:
+			teardown(state)
+	return times
+
+def benchmark_grid(size, pixdim, args):
+	rng = numpy.random.default_rng(args.seed)
+	shape, vox2world = synthetic_grid(size, pixdim)
+	world2vox = numpy.linalg.inv(vox2world)
+	target, avoid = synthetic_masks(shape, pixdim)
+	needles = synthetic_needles(shape, pixdim, args.needles, rng)
+	diameter = ablation.GEOMETRY_DIAMETER_DEF
+	safezone = ablation.GEOMETRY_SAFEZONE_DEF
+	repeat = args.repeat
+	stages = {}
+
+	def engine_new():
+		return ablation.Engine(shape, pixdim, vox2world, 2, args.workers)
+
+	def engine_drawn():
+		engine = engine_new()
+		engine.target_insert(target)
+		engine.labels(needles, 'full', diameter, safezone)
+		return engine
+
+	stages['pair2voxels_sample'] = measure(lambda _: [
+		ablation.pair2voxels_sample(needle['entry'], needle['target'], world2vox, pixdim, shape)
+		for needle in needles
+	], repeat)
+	stages['pair2voxels_traverse'] = measure(lambda _: [
+		ablation.pair2voxels_traverse(needle['entry'], needle['target'], world2vox, shape)
+		for needle in needles
+	], repeat)
+	stages['capsule_distance'] = measure(lambda _: [
+		ablation.capsule_distance(
+			needle['entry'],
+			needle['target'],
+			vox2world,
+			ablation.capsule_box(needle['entry'], needle['target'], world2vox, shape, ablation.GEOMETRY_SAFEZONE_MAX),
+		)
+		for needle in needles
+	], repeat)
+
+	def engine_fields():
+		engine = engine_new()
+		for needle in needles:
+			engine.needle_field(needle, max(diameter / 2, safezone))
+		return engine
+
+	stages['threshold'] = measure(lambda engine: [
+		engine.needle_raster(needle, 'full', diameter, safezone)
+		for needle in needles
+	], repeat, engine_fields, ablation.Engine.close)
+	stages['rasterize_line'] = measure(lambda engine: engine.rasterize([
+		(needle, i + 1, True)
+		for i, needle in enumerate(needles)
+	], 'line', diameter, safezone), repeat, engine_new, ablation.Engine.close)
+	stages['rasterize_full'] = measure(lambda engine: engine.rasterize([
+		(needle, i + 1, True)
+		for i, needle in enumerate(needles)
+	], 'full', diameter, safezone), repeat, engine_new, ablation.Engine.close)
+
+	def engine_moved():
+		# one needle moved by a voxel, as while scrubbing in the panel
+		engine = engine_drawn()
+		moved = dict(needles[-1], target=tuple(x + p for x, p in zip(needles[-1]['target'], pixdim)))
+		return engine, needles[:-1] + [moved]
+
+	stages['rasterize_incremental'] = measure(lambda state: state[0].rasterize([
+		(needle, i + 1, True)
+		for i, needle in enumerate(state[1])
+	], 'full', diameter, safezone), repeat, engine_moved, lambda state: state[0].close())
+	stages['target_index'] = measure(lambda _: ablation.mask_index(target), repeat)
+	stages['avoid_field'] = measure(lambda _: ablation.mask_field(avoid, pixdim, 1.), repeat)
+	stages['coverage'] = measure(
+		lambda engine: ablation.mask_overlap(engine.targets[0], engine.targets[0]['box'], engine.draw_array),
+		repeat,
+		engine_drawn,
+		ablation.Engine.close,
+	)
+
+	def engine_avoid():
+		engine = engine_new()
+		engine.avoid_insert(avoid)
+		return engine
+
+	stages['avoid_check'] = measure(lambda engine: engine.avoid_clearances(0, [
+		(i + 1, needle)
+		for i, needle in enumerate(needles)
+	]), repeat, engine_avoid, ablation.Engine.close)
+
+	def engine_masks():
+		engine = engine_avoid()
+		engine.target_insert(target)
+		return engine
+
+	stages['optimize'] = measure(
+		lambda engine: engine.optimize(0, args.needles, (), diameter, safezone),
+		repeat,
+		engine_masks,
+		ablation.Engine.close,
+	)
+
+	def write_region():
+		engine = engine_new()
+		result = engine.labels(needles, 'full', diameter, safezone)
+		region = ablation.box_union([raster['box'] for raster in engine.cache.values()])
+		engine.close()
+		return numpy.zeros(shape, dtype=ablation.LABEL_DTYPE), region, result[region].copy()
+
+	def write_array(state):
+		array, region, data = state
+		array[region] = data
+
+	stages['write_array'] = measure(write_array, repeat, write_region)
+	try:
+		import fsl.data.image
+	except ImportError:
+		fsl = None
+	if fsl is not None:
+		def write_image():
+			_, region, data = write_region()
+			image = fsl.data.image.Image(numpy.zeros(shape, dtype=ablation.LABEL_DTYPE), xform=vox2world)
+			return image, region, data
+		stages['write_image'] = measure(write_array, repeat, write_image)
+	return [
+		{
+			'stage': stage,
+			'shape': list(shape),
+			'pixdim': list(pixdim),
+			'times': times,
+			'min': min(times),
+			'median': statistics.median(times),
+		}
+		for stage, times in stages.items()
+	]
+
+def summary(results, baseline, fp):
+	medians = {}
+	if baseline is not None:
+		medians = {
+			(result['stage'], tuple(result['shape']), tuple(result['pixdim'])): result['median']
+			for result in baseline['results']
+		}
+	for result in results:
+		key = (result['stage'], tuple(result['shape']), tuple(result['pixdim']))
+		line = '{:<24} {:>15} {:>15} {:>10.1f} ms'.format(
+			result['stage'],
+			'x'.join(str(x) for x in result['shape']),
+			'x'.join('{:g}'.format(x) for x in result['pixdim']),
+			1e3 * result['median'],
+		)
+		if medians.get(key):
+			line += ' {:>7.2f}x'.format(result['median'] / medians[key])
+		print(line, file=fp)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(
+		description='Time the planning engine stages on synthetic volumes.',
+	)
+	parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES, help='edge lengths of the cubic grids')
+	parser.add_argument('-p', '--pixdims', choices=PIXDIMS, nargs='+', default=list(PIXDIMS), help='voxel spacings')
+	parser.add_argument('-n', '--needles', type=int, default=10, help='needles per synthetic plan')
+	parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per stage')
+	parser.add_argument('-w', '--workers', type=int, default=ablation.DRAW_WORKERS, help='draw worker threads')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic needles')
+	parser.add_argument('-o', '--output', help='json output file (default: stdout)')
+	parser.add_argument('-c', '--compare', help='json output of a previous run to compare medians with')
+	args = parser.parse_args(argv)
+	baseline = None
+	if args.compare is not None:
+		with open(args.compare, 'r') as fp:
+			baseline = json.load(fp)
+	document = {
+		'meta': {
+			'version': version(),
+			'python': platform.python_version(),
+			'numpy': numpy.__version__,
+			'scipy': scipy.__version__,
+			'machine': platform.platform(),
+			'cpus': os.cpu_count(),
+			'workers': args.workers,
+			'needles': args.needles,
+			'repeat': args.repeat,
+			'seed': args.seed,
+		},
+		'results': [],
+	}
+	for size in args.sizes:
+		for name in args.pixdims:
+			results = benchmark_grid(size, PIXDIMS[name], args)
+			document['results'].extend(results)
+			summary(results, baseline, sys.stderr)
+	if args.output is not None:
+		with open(args.output, 'w') as fp:
+			json.dump(document, fp, indent='\t')
+			fp.write('\n')
+	else:
+		json.dump(document, sys.stdout, indent='\t')
+		sys.stdout.write('\n')
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+
+import argparse
+import concurrent.futures
+import csv
+import functools
+import json
+import os.path
+import sys
+import zipfile
+
+import nibabel
+import numpy
+
+import ablation
+
+
+"""
+
+manifest : dict
+	plans : dict[]
+		plan : str
+		subject : str|none
+		reference : str|none
+		targets : str[]
+		avoids : str[]
+
+Relative paths are resolved against the directory of the manifest.
+Plans that share a subject, or the same mask files when no subject is
+given, are evaluated in one task so that their masks are loaded once.
+
+"""
+
+
+XYZ_UNITS = {
+	'meter': 1,
+	'mm': 2,
+	'micron': 3,
+}
+
+
+def manifest_load(path):
+	with open(path, 'r') as fp:
+		manifest = json.load(fp)
+	assert type(manifest) is dict
+	assert 'plans' in manifest and type(manifest['plans']) is list
+	root = os.path.dirname(os.path.abspath(path))
+	entries = []
+	for index, entry in enumerate(manifest['plans']):
+		assert type(entry) is dict
+		assert 'plan' in entry and type(entry['plan']) is str
+		for key in ['targets', 'avoids']:
+			assert type(entry.get(key, [])) is list
+			assert all(type(value) is str for value in entry.get(key, []))
+		entry = {
+			'index': index,
+			'plan': os.path.join(root, entry['plan']),
+			'subject': entry.get('subject'),
+			'reference': entry.get('reference'),
+			'targets': [os.path.join(root, value) for value in entry.get('targets', [])],
+			'avoids': [os.path.join(root, value) for value in entry.get('avoids', [])],
+		}
+		if entry['reference'] is not None:
+			entry['reference'] = os.path.join(root, entry['reference'])
+		entries.append(entry)
+	return entries
+
+def manifest_groups(entries):
+	groups = {}
+	for entry in entries:
+		if entry['subject'] is not None:
+			key = ('subject', entry['subject'])
+		else:
+			key = ('masks', entry['reference'], tuple(entry['targets']), tuple(entry['avoids']))
+		groups.setdefault(key, []).append(entry)
+	return list(groups.values())
+
+def nifti_load(path):
+	image = nibabel.load(path)
+	units = image.header.get_xyzt_units()[0]
+	return {
+		'data': numpy.asanyarray(image.dataobj),
+		'pixdim': tuple(float(x) for x in image.header.get_zooms()[:3]),
+		'vox2world': image.affine,
+		'units': XYZ_UNITS.get(units, 0),
+	}
+
+def nifti_compatible(a, b):
+	return a['data'].shape == b['data'].shape \
+		and numpy.allclose(a['vox2world'], b['vox2world']) \
+		and a['units'] == b['units']
+
+def group_evaluate(entries, cache=None, margin=ablation.NEEDLE_MARGIN):
+	mask_cache = None
+	if cache is not None:
+		mask_cache = ablation.MaskCache(cache)
+	results = []
+	engine = None
+	engine_grid = None
+	images = {}
+	targets = []
+	avoids = []
+	for entry in entries:
+		result = {
+			'index': entry['index'],
+			'plan': entry['plan'],
+			'subject': entry['subject'],
+			'error': None,
+			'targets': [],
+			'avoids': [],
+		}
+		results.append(result)
+		try:
+			bundle = None
+			try:
+				if entry['plan'].endswith('.npz'):
+					plan, *bundle = ablation.bundle_load(entry['plan'])
+				else:
+					with open(entry['plan'], 'r') as fp:
+						plan = json.load(fp)
+					ablation.plan_check(plan)
+			except (AssertionError, EOFError, KeyError, zipfile.BadZipFile):
+				raise ValueError('plan should have compatible content')
+			paths = entry['targets'] + entry['avoids']
+			if entry['reference'] is not None:
+				paths = [entry['reference']] + paths
+			if not paths:
+				raise ValueError('no reference image or mask')
+			for path in paths:
+				if path not in images:
+					images[path] = nifti_load(path)
+			grid = images[paths[0]]
+			if not all(nifti_compatible(grid, images[path]) for path in paths):
+				raise ValueError('masks should have identical shapes, affine transformations and units')
+			if engine is None or not nifti_compatible(grid, engine_grid):
+				if engine is not None:
+					engine.close()
+				engine = ablation.Engine(
+					grid['data'].shape,
+					grid['pixdim'],
+					grid['vox2world'],
+					grid['units'],
+					workers=1,
+					mask_cache=mask_cache,
+				)
+				engine_grid = grid
+				targets = []
+				avoids = []
+			if targets != entry['targets']:
+				while engine.targets:
+					engine.target_remove(0)
+				for path in entry['targets']:
+					engine.target_insert(images[path]['data'])
+				targets = entry['targets']
+			if avoids != entry['avoids']:
+				while engine.avoids:
+					engine.avoid_remove(0)
+				for path in entry['avoids']:
+					engine.avoid_insert(images[path]['data'])
+				avoids = entry['avoids']
+			engine.retained = {}
+			if bundle is not None:
+				engine.retained = engine.bundle_seeds(*bundle) or {}
+			needles = [{
+				'entry': tuple(needle['entry']),
+				'target': tuple(needle['target']),
+			} for needle in plan['needles']]
+			engine.labels(needles, 'full', plan['diameter'], plan['safezone'])
+			metrics = engine.metrics(needles, plan['safezone'])
+			contacts = engine.needle_contacts(needles, plan['diameter'], margin)
+			result['diameter'] = plan['diameter']
+			result['safezone'] = plan['safezone']
+			result['needles'] = len(needles)
+			result['contacts'] = [{
+				'needles': list(item['needles']),
+				'distance': item['distance'],
+			} for item in contacts]
+			result['targets'] = [{
+				'mask': path,
+				'coverage': None if coverage is None else 100. * coverage,
+				'needles': [{
+					'needle': item['needle'],
+					'covered': 100. * item['covered'] / count,
+					'unique': 100. * item['unique'] / count,
+					'shared': 100. * item['shared'] / count,
+				} for item in items],
+			} for path, coverage, items, count in zip(
+				entry['targets'],
+				metrics['targets'],
+				metrics['target_needles'],
+				[target['count'] for target in engine.targets],
+			)]
+			result['avoids'] = [{
+				'mask': path,
+				'violations': [item['needle'] for item in items if item['violation']],
+				'clearances': [{
+					'needle': item['needle'],
+					'clearance': float(item['clearance']),
+					'violation': bool(item['violation']),
+					'voxels': item['voxels'],
+					'volume': item['volume'],
+				} for item in items],
+			} for path, items in zip(entry['avoids'], metrics['avoids'])]
+		except (IOError, ValueError, nibabel.filebasedimages.ImageFileError) as error:
+			result['error'] = str(error)
+	if engine is not None:
+		engine.close()
+	return results
+
+def results_csv(results, fp):
+	writer = csv.writer(fp)
+	writer.writerow(['plan', 'subject', 'kind', 'mask', 'needle', 'coverage', 'unique', 'shared', 'clearance', 'violation', 'voxels', 'volume', 'error'])
+	for result in results:
+		if result['error'] is not None:
+			writer.writerow([result['plan'], result['subject'], '', '', '', '', '', '', '', '', '', '', result['error']])
+			continue
+		for target in result['targets']:
+			coverage = '' if target['coverage'] is None else '{:.1f}'.format(target['coverage'])
+			writer.writerow([result['plan'], result['subject'], 'target', target['mask'], '', coverage, '', '', '', '', '', '', ''])
+			for item in target['needles']:
+				writer.writerow([result['plan'], result['subject'], 'target', target['mask'], item['needle'], '{:.1f}'.format(item['covered']), '{:.1f}'.format(item['unique']), '{:.1f}'.format(item['shared']), '', '', '', '', ''])
+		for avoid in result['avoids']:
+			for item in avoid['clearances']:
+				writer.writerow([result['plan'], result['subject'], 'avoid', avoid['mask'], item['needle'], '', '', '', '{:.2f}'.format(item['clearance']), int(item['violation']), item['voxels'], '{:.1f}'.format(item['volume']), ''])
+		for item in result['contacts']:
+			writer.writerow([result['plan'], result['subject'], 'contact', '', '{:d}-{:d}'.format(*item['needles']), '', '', '', '{:.2f}'.format(item['distance']), 1, '', '', ''])
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(
+		description='Evaluate ablation needle plans against target and avoid masks.',
+	)
+	parser.add_argument('manifest', help='json manifest of plans and masks')
+	parser.add_argument('-o', '--output', help='csv or json output file (default: json to stdout)')
+	parser.add_argument('-c', '--cache', help='directory of cached mask indices and distance fields')
+	parser.add_argument('-m', '--margin', type=float, default=ablation.NEEDLE_MARGIN, help='mm added to the diameter below which two needles are reported as in contact')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+	args = parser.parse_args(argv)
+	try:
+		entries = manifest_load(args.manifest)
+	except (IOError, json.JSONDecodeError) as error:
+		parser.error(str(error))
+	except AssertionError:
+		parser.error('manifest should have compatible content')
+	groups = manifest_groups(entries)
+	results = []
+	with concurrent.futures.ProcessPoolExecutor(max(1, args.jobs)) as pool:
+		for group in pool.map(functools.partial(group_evaluate, cache=args.cache, margin=args.margin), groups):
+			results.extend(group)
+	results.sort(key=lambda result: result['index'])
+	if args.output is not None and args.output.endswith('.csv'):
+		with open(args.output, 'w', newline='') as fp:
+			results_csv(results, fp)
+	elif args.output is not None:
+		with open(args.output, 'w') as fp:
+			json.dump(results, fp, indent='\t')
+			fp.write('\n')
+	else:
+		json.dump(results, sys.stdout, indent='\t')
+		sys.stdout.write('\n')
+	return 0 if all(result['error'] is None for result in results) else 1
+
+
+if __name__ == '__main__':
+	sys.exit(main())
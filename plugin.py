@@ -1,26 +1,58 @@
 #!/usr/bin/python3
 
 
+import time
+
+PLUGIN_LOAD = time.perf_counter()
+
 import json
 import math
 import os.path
+import sys
+import threading
+import zipfile
 
 import fsleyes
 import numpy
-import scipy.ndimage
 import wx
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ablation
+
+
+colorama = None # imported by the first message with a mode; false if missing
+
+VERBOSITY_QUIET = 0
+VERBOSITY_WARNING = 1
+VERBOSITY_INFO = 2
+VERBOSITY_TIMING = 3
 
 try:
-	import colorama
-except ModuleNotFoundError:
-	colorama = None
+	VERBOSITY = int(os.environ.get('ABLATION_VERBOSITY', VERBOSITY_WARNING))
+except ValueError:
+	VERBOSITY = VERBOSITY_WARNING
+
+DEBUG_LEVELS = {
+	None: VERBOSITY_INFO,
+	'info': VERBOSITY_INFO,
+	'success': VERBOSITY_INFO,
+	'warning': VERBOSITY_WARNING,
+	'failure': VERBOSITY_WARNING,
+	'timing': VERBOSITY_TIMING,
+}
 
 def debug(*objects, sep=' ', end='\n', mode=None):
-	# IDEA verbosity
+	global colorama
+	if DEBUG_LEVELS[mode] > VERBOSITY:
+		return
+	if mode is not None and colorama is None:
+		try:
+			import colorama
+		except ModuleNotFoundError:
+			colorama = False
 	prefix = None
 	suffix = None
-	if mode is not None and colorama is not None:
+	if mode is not None and colorama:
 		if mode == 'info':
 			prefix = colorama.Fore.BLUE
 		elif mode == 'warning':
@@ -29,6 +61,8 @@ def debug(*objects, sep=' ', end='\n', mode=None):
 			prefix = colorama.Fore.GREEN
 		elif mode == 'failure':
 			prefix = colorama.Fore.RED
+		elif mode == 'timing':
+			prefix = colorama.Fore.MAGENTA
 		if prefix is not None:
 			suffix = colorama.Fore.RESET
 	if prefix is None:
@@ -39,69 +73,104 @@ def debug(*objects, sep=' ', end='\n', mode=None):
 	print('ablation:', *objects, sep=sep, end='')
 	print(suffix, end=end)
 
+def debug_timings(title, timings):
+	if timings is None or VERBOSITY < VERBOSITY_TIMING:
+		return
+	objects = [
+		'{:s} {:.1f} ms'.format(name, 1e3 * seconds)
+		for name, seconds in timings.items()
+	]
+	peak = ablation.memory_peak()
+	if peak is not None:
+		objects.append('peak {:.0f} MiB'.format(peak / (1 << 20)))
+	debug('{:s}:'.format(title), '; '.join(objects), mode='timing')
+
 debug('plugin loaded', mode='success')
 
 
-GEOMETRY_DIAMETER_MIN = 1
-GEOMETRY_DIAMETER_MAX = 20
-GEOMETRY_DIAMETER_DEF = 3
+try:
+	HISTORY_BUDGET = int(os.environ['ABLATION_HISTORY_MB']) << 20
+except (KeyError, ValueError):
+	HISTORY_BUDGET = ablation.HISTORY_BUDGET
+
+try:
+	DRAW_WORKERS = max(1, int(os.environ['ABLATION_DRAW_WORKERS']))
+except (KeyError, ValueError):
+	DRAW_WORKERS = ablation.DRAW_WORKERS
+
+MASK_CACHE_DIRECTORY = os.path.join(
+	os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+	'fsleyes-plugin-ablation',
+)
+
+try:
+	MASK_CACHE_LIMIT = int(os.environ['ABLATION_CACHE_MB']) << 20
+except (KeyError, ValueError):
+	MASK_CACHE_LIMIT = ablation.MASK_CACHE_LIMIT
+
+try:
+	NEEDLE_MARGIN = float(os.environ['ABLATION_NEEDLE_MARGIN'])
+except (KeyError, ValueError):
+	NEEDLE_MARGIN = ablation.NEEDLE_MARGIN
+
+OPTIMIZER_NEEDLES = 20 # at most proposed at once
+
+SLIDER_STEPS = 100
+SLIDER_RATE = 60 # Hz, when the display does not report its refresh rate
 
-GEOMETRY_SAFEZONE_MIN = 1
-GEOMETRY_SAFEZONE_MAX = 50
-GEOMETRY_SAFEZONE_DEF = 15
+PLUGIN_IMPORT = time.perf_counter() - PLUGIN_LOAD
 
-GEOMETRY_BORDER = 2
 
+FA_BITMAPS = {}
 
 def fa(icon):
-	name = os.path.join(
-		os.path.dirname(__file__),
-		'fontawesome',
-		'{:s}.png'.format(icon),
-	)
-	return wx.Bitmap(name, wx.BITMAP_TYPE_PNG)
-
-def edt_box(mask, distance=0., zooms=None):
-	assert distance >= 0
-	if zooms is None:
-		zooms = (1,) * mask.ndim
-	assert len(zooms) == mask.ndim
-	assert all(x > 0 for x in zooms)
-	S = distance * numpy.reciprocal(zooms)
-	S = numpy.round(S).astype(int)
-	I = numpy.argwhere(mask)
-	LL = numpy.zeros(mask.ndim, dtype=int)
-	L = I.min(axis=0) - S
-	L = numpy.maximum(L, LL)
-	UU = numpy.asarray(mask.shape) + 1
-	U = I.max(axis=0) + S + 1
-	U = numpy.minimum(U, UU)
-	if numpy.array_equal(L, LL) and numpy.array_equal(U, UU):
-		return None
-	else:
-		return tuple(slice(l,u) for l, u in zip(L, U))
-
-def edt(mask, distance=1., zooms=None, box=False):
-	assert distance >= 0
-	if zooms is None:
-		zooms = (1,) * mask.ndim
-	assert len(zooms) == mask.ndim
-	assert all(x > 0 for x in zooms)
-	if box:
-		box = edt_box(mask, distance, zooms)
-	else:
-		box = None
-	if box is None:
-		temp = mask
-	else:
-		temp = mask[box]
-	temp = scipy.ndimage.distance_transform_edt(~temp, zooms)
-	if box is None:
-		mask = temp
-	else:
-		mask = numpy.full(mask.shape, distance)
-		mask[box] = temp
-	return mask
+	bitmap = FA_BITMAPS.get(icon)
+	if bitmap is None:
+		name = os.path.join(
+			os.path.dirname(__file__),
+			'fontawesome',
+			'{:s}.png'.format(icon),
+		)
+		bitmap = wx.Bitmap(name, wx.BITMAP_TYPE_PNG)
+		FA_BITMAPS[icon] = bitmap
+	return bitmap
+
+def fa_preload():
+	directory = os.path.join(os.path.dirname(__file__), 'fontawesome')
+	for name in sorted(os.listdir(directory)):
+		icon, ext = os.path.splitext(name)
+		if ext == '.png':
+			fa(icon)
+
+
+class NeedleListCtrl(wx.ListCtrl):
+
+	COLUMNS = {
+		'needle': 40,
+		'entry': 100,
+		'target': 100,
+		'nearest': 70,
+	}
+
+	def __init__(self, parent, text, flag):
+		super().__init__(
+			parent,
+			size=wx.Size(-1, 160),
+			style=wx.LC_REPORT|wx.LC_VIRTUAL|wx.LC_SINGLE_SEL|wx.LC_HRULES|wx.LC_VRULES,
+		)
+		for column, (label, width) in enumerate(self.COLUMNS.items()):
+			self.InsertColumn(column, label, width=width)
+		self.text = text
+		self.flag = flag
+		self.flag_attr = wx.ItemAttr()
+		self.flag_attr.SetTextColour(wx.RED)
+
+	def OnGetItemText(self, item, column):
+		return self.text(item, column)
+
+	def OnGetItemAttr(self, item):
+		return self.flag_attr if self.flag(item) else None
+
 
 
 """
@@ -112,11 +181,22 @@ self.init_items : sizeritem[]
 self.main_items : sizeritem[]
 self.form_items : sizeritem[]
 
-self.needle_sizer : sizer
+self.history_buttons : dict
+	undo : bitmapbutton
+	redo : bitmapbutton
+self.needle_list : needlelistctrl
+self.needle_buttons : dict
+	entry : bitmapbutton
+	target : bitmapbutton
+	update : bitmapbutton
+	clone : bitmapbutton
+	delete : bitmapbutton
 self.form_insert : bitmapbutton
 self.form_title : statictext
 self.form_submit : bitmapbutton
 self.form_slider : slider
+self.form_snap : checkbox
+self.form_timer : calllater|none
 self.form_coordinates : dict
 	entry : tuple of textctrl
 	target : tuple of textctrl
@@ -126,6 +206,9 @@ self.form_buttons : dict
 self.geometry_diameter : spinctrl
 self.geometry_safezone : spinctrl
 self.drawmode_title : statictext
+self.draw_indicator : activityindicator
+self.draw_readout : checkbox
+self.draw_timings : statictext
 self.drawmode_buttons : dict
 	none : bitmaptogglebutton
 	line : bitmaptogglebutton
@@ -133,31 +216,54 @@ self.drawmode_buttons : dict
 self.target_sizer : sizer
 self.danger_sizer : sizer
 
+self.mask_cache : maskcache|none
+
+self.draw_thread : thread
+self.draw_condition : condition
+self.draw_request : dict|none
+	instance : dict
+	generation : int
+	drawmode : str
+	diameter : int
+	safezone : int
+	needles : (dict, int, bool)[]
+	start : float
+self.draw_generation : int
+self.draw_stop : bool
+
 self.instance : dict|none
 	path : str|none
 	image : image
-	unit_factor : float
+	engine : engine
+	history : history
 	needles : dict[]
 		entry : tuple of float
 		target : tuple of float
-	buttons : dict
-		update : bitmapbutton[]
-		clone : bitmapbutton[]
-		delete : bitmapbutton[]
+	needle_nearest : (tuple|none)[]
+		closest other needle, its axis distance in mm and whether it is too close
 	form : dict|none
 		index : int
 		point : dict
 			entry : (tuple of float)|none
 			target : (tuple of float)|none
 		dirty : bool
+		trajectory : dict|none
+			t : ndarray
+			points : ndarray
 	geometry_diameter : int
 	geometry_safezone : int
 	drawmode : str
-	draw_array : ndarray|none
 	target_overlays : overlay|none
 	target_labels : textctrl[]
 	danger_overlays : overlay[]
 	danger_bitmaps : staticbitmap[]
+	optimizer : dict|none
+		instance : dict
+		target : overlay
+		cancel : event
+	proposals : dict[]
+		entry : tuple of float
+		target : tuple of float
 
 """
 
@@ -170,6 +276,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 
 	def __init__(self, *args, **kwargs):
 		debug('creating panel', mode='info')
+		start = time.perf_counter()
 		super().__init__(*args, **kwargs)
 		self.overlayList.addListener(
 			'overlays',
@@ -177,6 +284,9 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			self.on_overlay_list_changed,
 			immediate=True,
 		)
+		# icons
+		fa_preload()
+		icons = time.perf_counter() - start
 		# home sizer
 		home_sizer = wx.BoxSizer(wx.VERTICAL)
 		home_sizer.SetMinSize(280, 0)
@@ -197,10 +307,30 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		self.build_main_items(main_sizer)
 		main_sizer.AddSpacer(4)
 		horizontal_sizer.Add(main_sizer, 1)
+		self.form_timer = None
 		# horizontal spacer
 		horizontal_sizer.AddSpacer(4)
+		# mask cache
+		self.mask_cache = None
+		if MASK_CACHE_LIMIT > 0:
+			self.mask_cache = ablation.MaskCache(MASK_CACHE_DIRECTORY, MASK_CACHE_LIMIT)
+		# draw worker
+		self.draw_condition = threading.Condition()
+		self.draw_request = None
+		self.draw_generation = 0
+		self.draw_stop = False
+		self.draw_thread = threading.Thread(target=self.draw_worker, daemon=True)
+		self.draw_thread.start()
 		# reset
+		self.instance = None
 		self.reset()
+		ready = time.perf_counter()
+		debug_timings('panel', {
+			'import': PLUGIN_IMPORT,
+			'icons': icons,
+			'build': ready - start,
+			'ready': ready - PLUGIN_LOAD,
+		})
 
 	def build_init_items(self, main_sizer):
 		self.init_items = []
@@ -264,6 +394,20 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		button.SetToolTip('export needle list to json file')
 		button.Bind(wx.EVT_BUTTON, self.on_instance_save_button_click)
 		sizer.Add(button)
+		self.history_buttons = {}
+		for action, art in [('undo', wx.ART_UNDO), ('redo', wx.ART_REDO)]:
+			sizer.AddSpacer(4)
+			button = wx.BitmapButton(
+				self.window,
+				bitmap=wx.ArtProvider.GetBitmap(art, wx.ART_BUTTON, wx.Size(16, 16)),
+				size=wx.Size(26, 26),
+			)
+			button.SetToolTip(action)
+			handler = lambda event, action=action: \
+				self.on_history_button_click(event, action)
+			button.Bind(wx.EVT_BUTTON, handler)
+			sizer.Add(button)
+			self.history_buttons[action] = button
 		sizer.AddStretchSpacer()
 		sizer.AddSpacer(4)
 		button = wx.BitmapButton(
@@ -286,6 +430,29 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			label='needle list',
 		), flag=wx.ALIGN_CENTER_VERTICAL)
 		sizer.AddStretchSpacer()
+		self.needle_buttons = {}
+		for action, icon, tooltip, handler in [
+			('entry', 'crosshairs-solid-16', 'focus entry of selected needle',
+				lambda event: self.on_needle_view_button_click(event, self.needle_list_selected(), 'entry')),
+			('target', 'crosshairs-solid-16', 'focus target of selected needle',
+				lambda event: self.on_needle_view_button_click(event, self.needle_list_selected(), 'target')),
+			('update', 'pen-solid-16', 'update selected needle',
+				lambda event: self.on_needle_update_button_click(event, self.needle_list_selected())),
+			('clone', 'copy-solid-16', 'clone selected needle',
+				lambda event: self.on_needle_insert_button_click(event, self.needle_list_selected())),
+			('delete', 'minus-solid-16', 'remove selected needle',
+				lambda event: self.on_needle_delete_button_click(event, self.needle_list_selected())),
+		]:
+			sizer.AddSpacer(4)
+			button = wx.BitmapButton(
+				self.window,
+				bitmap=fa(icon),
+				size=wx.Size(26, 26),
+			)
+			button.SetToolTip(tooltip)
+			button.Bind(wx.EVT_BUTTON, handler)
+			sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
+			self.needle_buttons[action] = button
 		sizer.AddSpacer(4)
 		button = wx.BitmapButton(
 			self.window,
@@ -296,16 +463,16 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		handler = lambda event: \
 			self.on_needle_insert_button_click(event, 0)
 		button.Bind(wx.EVT_BUTTON, handler)
-		sizer.Add(button)
+		sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
 		self.form_insert = button
 		self.main_items.append(main_sizer.Add(sizer, flag=wx.EXPAND))
 		self.main_items.append(main_sizer.AddSpacer(4))
-		# needle list sizer
-		sizer = wx.FlexGridSizer(5, 4, 4)
-		sizer.SetFlexibleDirection(wx.HORIZONTAL)
-		sizer.AddGrowableCol(1)
-		self.main_items.append(main_sizer.Add(sizer, flag=wx.EXPAND))
-		self.needle_sizer = sizer
+		# needle list
+		listctrl = NeedleListCtrl(self.window, self.needle_list_text, self.needle_list_flag)
+		listctrl.Bind(wx.EVT_LIST_ITEM_SELECTED, self.on_needle_list_select)
+		listctrl.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.on_needle_list_select)
+		self.main_items.append(main_sizer.Add(listctrl, flag=wx.EXPAND))
+		self.needle_list = listctrl
 		self.main_items.append(main_sizer.AddSpacer(4))
 		# form
 		self.build_form_items(main_sizer)
@@ -351,8 +518,8 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			self.window,
 			size=wx.Size(56, 24),
 			style=wx.ALIGN_RIGHT,
-			min=GEOMETRY_DIAMETER_MIN,
-			max=GEOMETRY_DIAMETER_MAX,
+			min=ablation.GEOMETRY_DIAMETER_MIN,
+			max=ablation.GEOMETRY_DIAMETER_MAX,
 		)
 		spinctrl.Bind(wx.EVT_SPINCTRL, self.on_geometry_diameter_spinctrl_change)
 		sizer.Add(spinctrl, flag=wx.ALIGN_CENTER_VERTICAL)
@@ -371,8 +538,8 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			self.window,
 			size=wx.Size(56, 24),
 			style=wx.ALIGN_RIGHT,
-			min=GEOMETRY_SAFEZONE_MIN,
-			max=GEOMETRY_SAFEZONE_MAX,
+			min=ablation.GEOMETRY_SAFEZONE_MIN,
+			max=ablation.GEOMETRY_SAFEZONE_MAX,
 		)
 		spinctrl.Bind(wx.EVT_SPINCTRL, self.on_geometry_safezone_spinctrl_change)
 		sizer.Add(spinctrl, flag=wx.ALIGN_CENTER_VERTICAL)
@@ -387,6 +554,10 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		statictext = wx.StaticText(self.window)
 		sizer.Add(statictext, flag=wx.ALIGN_CENTER_VERTICAL)
 		self.drawmode_title = statictext
+		sizer.AddSpacer(4)
+		indicator = wx.ActivityIndicator(self.window)
+		sizer.Add(indicator, flag=wx.ALIGN_CENTER_VERTICAL)
+		self.draw_indicator = indicator
 		sizer.AddStretchSpacer()
 		self.drawmode_buttons = {
 			'none': fa('ban-solid-16'),
@@ -408,6 +579,26 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			self.drawmode_buttons[mode] = button
 		self.main_items.append(main_sizer.Add(sizer, flag=wx.EXPAND))
 		self.main_items.append(main_sizer.AddSpacer(4))
+		# draw timings sizer
+		sizer = wx.BoxSizer(wx.HORIZONTAL)
+		checkbox = wx.CheckBox(
+			self.window,
+			label='timings',
+		)
+		checkbox.SetToolTip('show the duration of the last draw')
+		checkbox.SetValue(VERBOSITY >= VERBOSITY_TIMING)
+		checkbox.Bind(wx.EVT_CHECKBOX, self.on_draw_readout_checkbox_click)
+		sizer.Add(checkbox, flag=wx.ALIGN_CENTER_VERTICAL)
+		self.draw_readout = checkbox
+		sizer.AddSpacer(4)
+		statictext = wx.StaticText(
+			self.window,
+			style=wx.ST_ELLIPSIZE_END,
+		)
+		sizer.Add(statictext, 1, flag=wx.ALIGN_CENTER_VERTICAL)
+		self.draw_timings = statictext
+		self.main_items.append(main_sizer.Add(sizer, flag=wx.EXPAND))
+		self.main_items.append(main_sizer.AddSpacer(4))
 		# target line
 		self.main_items.append(main_sizer.Add(wx.StaticLine(self.window), flag=wx.EXPAND))
 		self.main_items.append(main_sizer.AddSpacer(4))
@@ -556,17 +747,34 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 				self.on_needle_mark_button_click(event, which)
 			button.Bind(wx.EVT_BUTTON, handler)
 			table_sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
-		# form slider
+		# form slider sizer
+		sizer = wx.BoxSizer(wx.HORIZONTAL)
 		slider = wx.Slider(self.window)
 		slider.Bind(wx.EVT_SCROLL_THUMBTRACK, self.on_needle_slider_scroll)
 		slider.Bind(wx.EVT_SCROLL_CHANGED, self.on_needle_slider_scroll)
-		self.form_items.append(main_sizer.Add(slider, flag=wx.EXPAND))
+		sizer.Add(slider, 1, flag=wx.ALIGN_CENTER_VERTICAL)
 		self.form_slider = slider
+		sizer.AddSpacer(4)
+		checkbox = wx.CheckBox(
+			self.window,
+			label='snap',
+		)
+		checkbox.SetToolTip('snap to voxel centre crossings')
+		checkbox.Bind(wx.EVT_CHECKBOX, self.on_needle_snap_checkbox_click)
+		sizer.Add(checkbox, flag=wx.ALIGN_CENTER_VERTICAL)
+		self.form_snap = checkbox
+		self.form_items.append(main_sizer.Add(sizer, flag=wx.EXPAND))
 		self.form_items.append(main_sizer.AddSpacer(4))
 
 	def destroy(self):
 		debug('destroying panel', mode='info')
 		self.overlayList.removeListener('overlays', self.name)
+		with self.draw_condition:
+			self.draw_stop = True
+			self.draw_condition.notify()
+		if self.instance is not None:
+			self.optimize_cancel()
+			self.instance['engine'].close()
 		super().destroy()
 
 	def start_show(self):
@@ -585,7 +793,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		assert self.instance['form'] is None
 		for item in self.main_items:
 			item.Show(True)
-		self.needle_sizer_refresh()
+		self.needle_list_refresh()
 		self.geometry_diameter.SetValue(self.instance['geometry_diameter'])
 		self.geometry_safezone.SetValue(self.instance['geometry_safezone'])
 		self.on_drawmode_button_click(None, 'line')
@@ -594,97 +802,88 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		assert self.instance is None
 		for item in self.main_items:
 			item.Show(False)
-		self.needle_sizer.Clear(True)
+		self.needle_list.SetItemCount(0)
 		self.danger_sizer.Clear(True)
 
-	def needle_sizer_refresh(self):
+	def needle_list_refresh(self, *indices):
 		assert self.instance is not None
-		assert self.instance['form'] is None
-		self.needle_sizer.Clear(True)
-		self.instance['buttons']['update'].clear()
-		self.instance['buttons']['clone'].clear()
-		self.instance['buttons']['delete'].clear()
-		for i, needle in enumerate(self.instance['needles']):
-			index = i + 1
-			# index text
-			self.needle_sizer.Add(wx.StaticText(
-				self.window,
-				label='#{:d}'.format(index),
-				size=wx.Size(40, 16),
-			), flag=wx.ALIGN_CENTER_VERTICAL)
-			# coordinates
-			sizer = wx.FlexGridSizer(4, 1, 1)
-			for which, point in needle.items():
-				for x in point:
-					sizer.Add(wx.TextCtrl(
-						self.window,
-						value='{:.0f}'.format(x),
-						size=wx.Size(30, 24),
-						style=wx.TE_READONLY|wx.TE_RIGHT,
-					), flag=wx.ALIGN_CENTER_VERTICAL)
-				button = wx.BitmapButton(
-					self.window,
-					bitmap=fa('crosshairs-solid-16'),
-					size=wx.Size(26, 26),
-				)
-				button.SetToolTip('focus')
-				handler = lambda event, index=index, which=which: \
-					self.on_needle_view_button_click(event, index, which)
-				button.Bind(wx.EVT_BUTTON, handler)
-				sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
-			self.needle_sizer.Add(sizer)
-			# update button
-			button = wx.BitmapButton(
-				self.window,
-				bitmap=fa('pen-solid-16'),
-				size=wx.Size(26, 26),
-			)
-			button.SetToolTip('update needle #{:d}'.format(index))
-			handler = lambda event, index=index: \
-				self.on_needle_update_button_click(event, index)
-			button.Bind(wx.EVT_BUTTON, handler)
-			self.needle_sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
-			self.instance['buttons']['update'].append(button)
-			# clone button
-			button = wx.BitmapButton(
-				self.window,
-				bitmap=fa('copy-solid-16'),
-				size=wx.Size(26, 26),
-			)
-			button.SetToolTip('clone needle #{:d}'.format(index))
-			handler = lambda event, index=index: \
-				self.on_needle_insert_button_click(event, index)
-			button.Bind(wx.EVT_BUTTON, handler)
-			self.needle_sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
-			self.instance['buttons']['clone'].append(button)
-			# delete button
-			button = wx.BitmapButton(
-				self.window,
-				bitmap=fa('minus-solid-16'),
-				size=wx.Size(26, 26),
-			)
-			button.SetToolTip('remove needle #{:d}'.format(index))
-			handler = lambda event, index=index: \
-				self.on_needle_delete_button_click(event, index)
-			button.Bind(wx.EVT_BUTTON, handler)
-			self.needle_sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
-			self.instance['buttons']['delete'].append(button)
+		count = len(self.instance['needles'])
+		if self.needle_list.GetItemCount() != count:
+			self.needle_list.SetItemCount(count)
+		# nearest needles change along with their neighbours
+		nearest = [None] * count
+		if count > 1:
+			distances = self.instance['engine'].needle_distances(self.instance['needles'])
+			limit = self.instance['geometry_diameter'] + NEEDLE_MARGIN
+			for i, j in enumerate(distances.argmin(axis=1)):
+				nearest[i] = (int(j) + 1, float(distances[i, j]), bool(distances[i, j] < limit))
+		previous = self.instance['needle_nearest']
+		indices = set(indices) | {
+			i + 1
+			for i in range(count)
+			if i >= len(previous) or previous[i] != nearest[i]
+		}
+		self.instance['needle_nearest'] = nearest
+		for index in indices:
+			if index - 1 in range(count):
+				self.needle_list.RefreshItem(index - 1)
+		self.needle_list_select()
+
+	def needle_list_text(self, item, column):
+		if self.instance is None or item not in range(len(self.instance['needles'])):
+			return ''
+		if column == 0:
+			return '#{:d}'.format(item + 1)
+		if column == 3:
+			nearest = self.instance['needle_nearest'][item]
+			return '' if nearest is None else '#{:d} {:.1f}'.format(*nearest[:2])
+		point = self.instance['needles'][item][['entry', 'target'][column - 1]]
+		return ' '.join('{:.0f}'.format(x) for x in point)
+
+	def needle_list_flag(self, item):
+		# closer to another needle than the diameter plus the margin
+		if self.instance is None or item not in range(len(self.instance['needle_nearest'])):
+			return False
+		nearest = self.instance['needle_nearest'][item]
+		return nearest is not None and nearest[2]
+
+	def needle_list_selected(self):
+		item = self.needle_list.GetFirstSelected()
+		return item + 1 if item != wx.NOT_FOUND else 0
+
+	def needle_list_select(self):
+		enable = self.instance is not None and self.instance['form'] is None and self.needle_list_selected() > 0
+		for button in self.needle_buttons.values():
+			button.Enable(enable)
+		self.history_refresh()
+
+	def history_refresh(self):
+		enable = self.instance is not None and self.instance['form'] is None
+		history = self.instance['history'] if enable else None
+		self.history_buttons['undo'].Enable(enable and history.can_undo())
+		self.history_buttons['redo'].Enable(enable and history.can_redo())
+
+	def history_push(self):
+		assert self.instance is not None
+		engine = self.instance['engine']
+		history = self.instance['history']
+		history.push(self.instance['needles'], engine.cache)
+		engine.retained = history.rasters()
+		self.history_refresh()
 
 	def needle_list_enable(self):
 		assert self.instance is not None
 		assert self.instance['form'] is None
 		self.form_insert.Enable()
-		for buttons in self.instance['buttons'].values():
-			for button in buttons:
-				button.Enable()
+		self.needle_list.Enable()
+		self.needle_list_select()
 
 	def needle_list_disable(self):
 		assert self.instance is not None
 		assert self.instance['form'] is not None
 		self.form_insert.Disable()
-		for buttons in self.instance['buttons'].values():
-			for button in buttons:
-				button.Disable()
+		self.needle_list.Disable()
+		self.needle_list_select()
 
 	def form_show(self):
 		assert self.instance is not None
@@ -700,6 +899,9 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 
 	def form_hide(self):
 		assert self.instance is None or self.instance['form'] is None
+		if self.form_timer is not None:
+			self.form_timer.Stop()
+			self.form_timer = None
 		for item in self.form_items:
 			item.Show(False)
 		self.form_title.SetLabel('')
@@ -724,12 +926,54 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		)
 		self.form_submit.Enable(enable)
 		self.form_slider.Enable(enable)
+		self.form_snap.Enable(enable)
+		self.form_trajectory_refresh()
+
+	def form_trajectory_refresh(self):
+		assert self.instance is not None
+		assert self.instance['form'] is not None
+		form = self.instance['form']
+		if not all(point is not None for point in form['point'].values()):
+			form['trajectory'] = None
+			return
+		t = None
+		if form['trajectory'] is not None:
+			t = form['trajectory']['t'][self.form_slider.GetValue()]
+		steps = None if self.form_snap.GetValue() else SLIDER_STEPS
+		form['trajectory'] = dict(zip(['t', 'points'], ablation.trajectory(
+			form['point']['entry'],
+			form['point']['target'],
+			self.instance['engine'].world2vox,
+			steps,
+		)))
+		self.form_slider.SetRange(0, len(form['trajectory']['t']) - 1)
+		if t is not None:
+			self.form_slider.SetValue(int(numpy.abs(form['trajectory']['t'] - t).argmin()))
+
+	def form_slider_apply(self):
+		if self.form_timer is not None:
+			self.form_timer.Stop()
+			self.form_timer = None
+		if self.instance is None or self.instance['form'] is None:
+			return
+		trajectory = self.instance['form']['trajectory']
+		if trajectory is None:
+			return
+		point = trajectory['points'][self.form_slider.GetValue()]
+		self.displayCtx.worldLocation.xyz = tuple(point)
+
+	def form_slider_interval(self):
+		refresh = 0
+		index = wx.Display.GetFromWindow(self)
+		if index != wx.NOT_FOUND:
+			refresh = wx.Display(index).GetCurrentMode().refresh
+		return math.ceil(1000 / (refresh or SLIDER_RATE))
 
 	def target_sizer_refresh(self):
 		assert self.instance is not None
 		self.instance['target_labels'].clear()
 		self.target_sizer.Clear(True)
-		for overlay in self.instance['target_overlays']:
+		for i, overlay in enumerate(self.instance['target_overlays']):
 			# text
 			textctrl = wx.TextCtrl(
 				self.window,
@@ -738,7 +982,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			)
 			self.target_sizer.Add(textctrl, flag=wx.ALIGN_CENTER_VERTICAL)
 			self.instance['target_labels'].append(textctrl)
-			self.target_overlay_check(overlay, textctrl)
+			self.target_overlay_check(i, textctrl)
 			# name text
 			sizer = wx.BoxSizer(wx.HORIZONTAL)
 			self.target_sizer.Add(sizer, flag=wx.EXPAND)
@@ -749,6 +993,19 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			)
 			statictext.SetToolTip(overlay.name)
 			sizer.Add(statictext, 1, flag=wx.ALIGN_CENTER_VERTICAL)
+			# optimize button
+			optimizer = self.instance['optimizer']
+			running = optimizer is not None and optimizer['target'] is overlay
+			button = wx.BitmapButton(
+				self.window,
+				bitmap=fa('xmark-solid-16' if running else 'crosshairs-solid-16'),
+				size=wx.Size(26, 26),
+			)
+			button.SetToolTip('cancel needle proposal' if running else 'propose needles covering this target mask')
+			handler = lambda event, overlay=overlay: \
+				self.on_target_optimize_button_click(event, overlay)
+			button.Bind(wx.EVT_BUTTON, handler)
+			sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
 			# select button
 			button = wx.BitmapButton(
 				self.window,
@@ -772,20 +1029,44 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			button.Bind(wx.EVT_BUTTON, handler)
 			self.target_sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
 
-	def target_overlay_check(self, overlay, textctrl):
+	def target_overlay_check(self, i, textctrl):
 		value = ''
-		if self.instance['draw_array'] is not None:
-			den = numpy.count_nonzero(overlay.data)
-			if den > 0:
-				num = numpy.count_nonzero(overlay.data * self.instance['draw_array'])
-				value = '{:.0f}%'.format(100. * num / den)
+		tooltip = None
+		if self.instance['drawmode'] != 'none':
+			coverage = self.instance['engine'].target_coverage(i)
+			if coverage is not None:
+				value = '{:.0f}%'.format(100. * coverage)
+				tooltip = '\n'.join(
+					'#{:d}: {:.0f}% ({:.0f}% alone, {:.0f}% shared)'.format(
+						item['needle'],
+						item['covered'],
+						item['unique'],
+						item['shared'],
+					)
+					for item in self.target_overlay_needles(i)
+				) or None
 		textctrl.SetValue(value)
+		textctrl.SetToolTip(tooltip)
+
+	def target_overlay_needles(self, i):
+		# percentages of target i per needle, numbered as in the needle list
+		engine = self.instance['engine']
+		count = engine.targets[i]['count']
+		needles = []
+		for item in engine.target_needles(i):
+			needles.append({
+				'needle': self.plan_index(item['needle']),
+				'covered': 100. * item['covered'] / count,
+				'unique': 100. * item['unique'] / count,
+				'shared': 100. * item['shared'] / count,
+			})
+		return sorted(needles, key=lambda item: item['needle'])
 
 	def danger_sizer_refresh(self):
 		assert self.instance is not None
 		self.instance['danger_bitmaps'].clear()
 		self.danger_sizer.Clear(True)
-		for overlay in self.instance['danger_overlays']:
+		for i, overlay in enumerate(self.instance['danger_overlays']):
 			# bitmap
 			staticbitmap = wx.StaticBitmap(
 				self.window,
@@ -793,7 +1074,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			)
 			self.danger_sizer.Add(staticbitmap, flag=wx.ALIGN_CENTER_VERTICAL)
 			self.instance['danger_bitmaps'].append(staticbitmap)
-			self.danger_overlay_check(overlay, staticbitmap)
+			self.danger_overlay_check(i, staticbitmap)
 			# name text
 			sizer = wx.BoxSizer(wx.HORIZONTAL)
 			self.danger_sizer.Add(sizer, flag=wx.EXPAND)
@@ -827,19 +1108,55 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			button.Bind(wx.EVT_BUTTON, handler)
 			self.danger_sizer.Add(button, flag=wx.ALIGN_CENTER_VERTICAL)
 
-	def danger_overlay_check(self, overlay, staticbitmap):
+	def danger_overlay_check(self, i, staticbitmap):
 		icon = 'circle-check-solid-16'
 		tooltip = None
-		if self.instance['draw_array'] is not None:
-			index = numpy.amax(overlay.data.astype(bool) * self.instance['draw_array'])
-			if index > 0:
-				if index > len(self.instance['needles']):
-					index = self.instance['form']['index']
-				icon = 'triangle-exclamation-solid-16'
-				tooltip = '#{:d}'.format(index)
+		report = self.danger_overlay_report(i)
+		if report:
+			item = min(report, key=lambda item: item['clearance'])
+			lines = ['clearance: {:.1f} mm (#{:d})'.format(item['clearance'], item['needle'])]
+			for item in report:
+				if item['violation'] or item['voxels'] > 0:
+					icon = 'triangle-exclamation-solid-16'
+					lines.append('#{:d}: {:.1f} mm, {:d} voxels ({:.1f} mm\u00b3) inside'.format(
+						item['needle'],
+						item['clearance'],
+						item['voxels'],
+						item['volume'],
+					))
+			tooltip = '\n'.join(lines)
 		staticbitmap.SetBitmap(fa(icon))
 		staticbitmap.SetToolTip(tooltip)
 
+	def danger_overlay_report(self, i):
+		# clearance and drawn voxels inside avoid i per needle, numbered as in the needle list
+		return self.instance['engine'].avoid_report(
+			i,
+			self.plan_needles(),
+			self.instance['geometry_safezone'],
+		)
+
+	def plan_index(self, index):
+		# the form needle is drawn after the list even when it updates a needle
+		form = self.instance['form']
+		if form is not None and form['dirty'] and form['index'] > 0 and index == len(self.instance['needles']) + 1:
+			return form['index']
+		return index
+
+	def plan_needles(self):
+		assert self.instance is not None
+		needles = [
+			(i + 1, needle)
+			for i, needle in enumerate(self.instance['needles'])
+		]
+		form = self.instance['form']
+		if form is not None and form['dirty']:
+			if form['index'] > 0:
+				needles[form['index'] - 1] = (form['index'], form['point'])
+			else:
+				needles.append((len(needles) + 1, form['point']))
+		return needles
+
 	def layout(self):
 		self.GetSizer().Layout()
 
@@ -847,68 +1164,130 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		debug('draw', mode='info')
 		assert self.instance is not None
 		if self.instance['drawmode'] == 'none' and not force:
+			self.metrics_refresh()
 			return
-		image = self.instance['image']
-		data = numpy.zeros(image.shape, dtype=int)
+		needles = []
 		if self.instance['drawmode'] in ['line', 'full']:
-			needles = self.instance['needles'].copy()
-			if self.instance['form'] is not None and self.instance['form']['dirty']:
-				assert all(
-					point is not None
-					for point in self.instance['form']['point'].values()
-				)
-				needles.append(self.instance['form']['point'])
-			self.instance['draw_array'] = numpy.zeros(image.shape, dtype=int)
-			for i, needle in enumerate(needles):
+			form = self.instance['form']
+			for i, needle in enumerate(self.instance['needles']):
 				index = i + 1
 				draw_pass = True
-				if self.instance['form'] is not None and self.instance['form']['dirty'] and self.instance['form']['index'] == index:
+				if form is not None and form['dirty'] and form['index'] == index:
 					draw_pass = False
-				mask = self.pair2mask(needle['entry'], needle['target']) # 40ms/loop
-				if self.instance['drawmode'] == 'line':
-					data[mask] = index
-					if draw_pass:
-						self.instance['draw_array'][mask] = index
-				elif self.instance['drawmode'] == 'full':
-					mask = edt(
-						mask,
-						max(
-							self.instance['geometry_diameter'] / 2,
-							self.instance['geometry_safezone'],
-						) + 1e-6,
-						self.instance['image'].pixdim,
-						box=True,
-					) * self.instance['unit_factor'] # 1200ms/loop; with box: 50ms/loop
-					sz1 = mask > self.instance['geometry_safezone'] - GEOMETRY_BORDER
-					sz2 = mask <= self.instance['geometry_safezone']
-					data[sz1 * sz2] = 10 * index + 1 # 20ms/loop
-					dm2 = mask <= self.instance['geometry_diameter'] / 2
-					data[dm2] = 10 * index # 10ms/loop
-					if draw_pass:
-						self.instance['draw_array'][sz2] = index
-		else:
-			self.instance['draw_array'] = None
-		image[:] = data[:] # 300ms
-		for overlay, textctrl in zip(self.instance['target_overlays'], self.instance['target_labels']):
-			self.target_overlay_check(overlay, textctrl)
-		for overlay, staticbitmap in zip(self.instance['danger_overlays'], self.instance['danger_bitmaps']):
-			self.danger_overlay_check(overlay, staticbitmap)
-
-	def pair2mask(self, entry_xyz, target_xyz):
+				needles.append((dict(needle), index, draw_pass))
+			if form is not None and form['dirty']:
+				assert all(
+					point is not None
+					for point in form['point'].values()
+				)
+				needles.append((dict(form['point']), len(needles) + 1, True))
+		with self.draw_condition:
+			self.draw_generation += 1
+			self.draw_request = {
+				'instance': self.instance,
+				'generation': self.draw_generation,
+				'drawmode': self.instance['drawmode'],
+				'diameter': self.instance['geometry_diameter'],
+				'safezone': self.instance['geometry_safezone'],
+				'needles': needles,
+				'start': time.perf_counter(),
+			}
+			self.draw_condition.notify()
+		self.draw_indicator.Start()
+
+	def draw_cancelled(self, request):
+		return request['generation'] != self.draw_generation or self.draw_stop
+
+	def draw_worker(self):
+		while True:
+			with self.draw_condition:
+				while self.draw_request is None and not self.draw_stop:
+					self.draw_condition.wait()
+				if self.draw_stop:
+					return
+				request = self.draw_request
+				self.draw_request = None
+			try:
+				result = self.draw_compute(request)
+			except Exception as error:
+				debug('draw failed:', repr(error), mode='failure')
+				result = {
+					'region': None,
+				}
+			if result is None:
+				continue
+			done = threading.Event()
+			wx.CallAfter(self.draw_publish, request, result, done)
+			while not done.wait(.1):
+				if self.draw_stop:
+					return
+
+	def draw_compute(self, request):
+		return request['instance']['engine'].rasterize(
+			request['needles'],
+			request['drawmode'],
+			request['diameter'],
+			request['safezone'],
+			lambda: self.draw_cancelled(request),
+		)
+
+	def draw_publish(self, request, result, done):
+		try:
+			if request['generation'] == self.draw_generation:
+				self.draw_indicator.Stop()
+			if self.instance is not request['instance']:
+				return
+			timings = result.get('timings')
+			with ablation.timer(timings, 'write'):
+				if result['region'] is not None:
+					self.instance['image'][result['region']] = result['data']
+			with ablation.timer(timings, 'metrics'):
+				self.metrics_refresh(timings)
+			if timings is not None:
+				timings['total'] = time.perf_counter() - request['start']
+				self.draw_timings_refresh(timings)
+				debug_timings('draw', timings)
+		finally:
+			done.set()
+
+	def draw_timings_refresh(self, timings):
+		if not self.draw_readout.GetValue():
+			self.draw_timings.SetLabel('')
+			self.draw_timings.SetToolTip(None)
+			return
+		stages = [
+			'{:s} {:.0f}'.format(name, 1e3 * timings.get(name, 0.))
+			for name in ['raster', 'merge', 'write', 'metrics']
+		]
+		self.draw_timings.SetLabel('last draw: {:.0f} ms ({:s})'.format(
+			1e3 * timings['total'],
+			' / '.join(stages),
+		))
+		tooltip = [
+			'{:s}: {:.1f} ms'.format(name, 1e3 * seconds)
+			for name, seconds in timings.items()
+		]
+		peak = ablation.memory_peak()
+		if peak is not None:
+			tooltip.append('peak memory: {:.0f} MiB'.format(peak / (1 << 20)))
+		self.draw_timings.SetToolTip('\n'.join(tooltip))
+
+	def draw_profile(self):
+		return VERBOSITY >= VERBOSITY_TIMING or self.draw_readout.GetValue()
+
+	def metrics_refresh(self, timings=None):
 		assert self.instance is not None
-		image = self.instance['image']
-		mask = numpy.zeros(image.shape, dtype=bool)
-		vector_xyz = numpy.asarray(target_xyz) - numpy.asarray(entry_xyz)
-		num = numpy.dot(numpy.abs(vector_xyz), numpy.reciprocal(image.pixdim))
-		num = round(num) + 1
-		debug('count', num)
-		for t in numpy.linspace(0, 1, num):
-			point_xyz = numpy.average([entry_xyz, target_xyz], 0, [1-t, t])
-			point_ijk = self.world2voxel(point_xyz)
-			mask[point_ijk] = True
-		return mask
+		for i, textctrl in enumerate(self.instance['target_labels']):
+			with ablation.timer(timings, 'coverage'):
+				self.target_overlay_check(i, textctrl)
+		for i, staticbitmap in enumerate(self.instance['danger_bitmaps']):
+			with ablation.timer(timings, 'clearance'):
+				self.danger_overlay_check(i, staticbitmap)
 
 	def reset(self):
+		if self.instance is not None:
+			self.optimize_cancel()
+			self.instance['engine'].close()
 		self.instance = None
 		self.start_show()
 		self.instance_hide()
@@ -928,34 +1307,26 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			)
 			return
 		path = None
+		bundle = None
+		timings = {} if self.draw_profile() else None
 		if load:
 			with wx.FileDialog(
 				self,
 				self.title(),
-				wildcard='JSON files (.json)|*.json',
+				wildcard='Needle list files (.json, .npz)|*.json;*.npz',
 				style=wx.FD_OPEN|wx.FD_FILE_MUST_EXIST,
 			) as file_dialog:
 				if file_dialog.ShowModal() == wx.ID_CANCEL:
 					return
 				path = file_dialog.GetPath()
 			try:
-				with open(path, 'r') as fp:
-					instance = json.load(fp)
-				assert type(instance) is dict
-				assert 'needles' in instance and type(instance['needles']) is list
-				for needle in instance['needles']:
-					assert type(needle) is dict
-					for which in ['entry', 'target']:
-						assert which in needle and type(needle[which]) is list
-						assert len(needle[which]) == 3
-						assert all(type(value) is float for value in needle[which])
-				assert 'diameter' in instance and type(instance['diameter']) is int
-				assert instance['diameter'] >= GEOMETRY_DIAMETER_MIN
-				assert instance['diameter'] <= GEOMETRY_DIAMETER_MAX
-				assert 'safezone' in instance and type(instance['safezone']) is int
-				assert instance['safezone'] >= GEOMETRY_SAFEZONE_MIN
-				assert instance['safezone'] <= GEOMETRY_SAFEZONE_MAX
-				assert instance['diameter'] <= 2 * instance['safezone']
+				with ablation.timer(timings, 'read'):
+					if path.endswith('.npz'):
+						instance, *bundle = ablation.bundle_load(path)
+					else:
+						with open(path, 'r') as fp:
+							instance = json.load(fp)
+						ablation.plan_check(instance)
 			except IOError as error:
 				wx.MessageBox(
 					str(error),
@@ -970,7 +1341,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 					wx.OK|wx.ICON_ERROR,
 				)
 				return
-			except AssertionError:
+			except (AssertionError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
 				wx.MessageBox(
 					'Input file should have compatible content.',
 					self.title(),
@@ -980,27 +1351,20 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		else:
 			instance = {
 				'needles': [],
-				'diameter': GEOMETRY_DIAMETER_DEF,
-				'safezone': GEOMETRY_SAFEZONE_DEF,
+				'diameter': ablation.GEOMETRY_DIAMETER_DEF,
+				'safezone': ablation.GEOMETRY_SAFEZONE_DEF,
 			}
-		image = fsleyes.actions.newimage.newImage(
-			overlay.shape,
-			overlay.pixdim,
-			int,
-			overlay.voxToWorldMat,
-			overlay.xyzUnits,
-			overlay.timeUnits,
-			name='{:s}-ablation'.format(overlay.name),
-		)
-		xyz_units = overlay.xyzUnits
-		if xyz_units == 1: # meters
-			unit_factor = 1e3
-		elif xyz_units == 2: # millimeters
-			unit_factor = 1e0
-		elif xyz_units == 3: # micrometers
-			unit_factor = 1e-3
-		else:
-			unit_factor = 1e0
+		with ablation.timer(timings, 'image'):
+			image = fsleyes.actions.newimage.newImage(
+				overlay.shape,
+				overlay.pixdim,
+				ablation.LABEL_DTYPE,
+				overlay.voxToWorldMat,
+				overlay.xyzUnits,
+				overlay.timeUnits,
+				name='{:s}-ablation'.format(overlay.name),
+			)
+		if overlay.xyzUnits not in ablation.UNIT_FACTORS:
 			wx.MessageBox(
 				'The selected overlay has unspecified units; assuming millimeters.',
 				self.title(),
@@ -1011,30 +1375,48 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		self.instance = {
 			'path': path,
 			'image': image,
-			'unit_factor': unit_factor,
+			'engine': ablation.Engine(
+				image.shape,
+				image.pixdim,
+				image.voxToWorldMat,
+				image.xyzUnits,
+				workers=DRAW_WORKERS,
+				mask_cache=self.mask_cache,
+			),
+			'history': None,
 			'needles': [{
 				'entry': tuple(needle['entry']),
 				'target': tuple(needle['target']),
 			} for needle in instance['needles']],
-			'buttons': {
-				'update': [],
-				'clone': [],
-				'delete': [],
-			},
+			'needle_nearest': [],
 			'form': None,
 			'geometry_diameter': instance['diameter'],
 			'geometry_safezone': instance['safezone'],
 			'drawmode': None,
-			'draw_array': None,
 			'target_overlays': [],
 			'target_labels': [],
 			'danger_overlays': [],
 			'danger_bitmaps': [],
+			'optimizer': None,
+			'proposals': [],
 		}
+		self.instance['engine'].profile = self.draw_profile()
+		seeds = None
+		if bundle is not None:
+			seeds = self.instance['engine'].bundle_seeds(*bundle)
+			if seeds is None:
+				wx.MessageBox(
+					'The needle list was saved on a different grid; needles will be drawn again.',
+					self.title(),
+					wx.OK|wx.ICON_WARNING,
+				)
+		self.instance['history'] = ablation.History(self.instance['needles'], HISTORY_BUDGET, seeds)
+		self.instance['engine'].retained = self.instance['history'].rasters()
 		self.start_hide()
 		self.instance_show()
 		self.layout()
 		self.draw()
+		debug_timings('load', timings)
 
 	def on_instance_save_button_click(self, event):
 		debug('save', mode='info')
@@ -1043,23 +1425,66 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		with wx.FileDialog(
 			self,
 			self.title(),
-			wildcard='JSON files (.json)|*.json',
+			wildcard='JSON files (.json)|*.json|Needle list bundles (.npz)|*.npz',
 			style=wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT,
 		) as file_dialog:
 			if self.instance['path'] is not None:
 				file_dialog.SetPath(self.instance['path'])
+				if self.instance['path'].endswith('.npz'):
+					file_dialog.SetFilterIndex(1)
 			if file_dialog.ShowModal() == wx.ID_CANCEL:
 				return
 			path = file_dialog.GetPath()
+			# the bundle filter decides the format even when no extension is typed
+			bundle = file_dialog.GetFilterIndex() == 1 or path.endswith('.npz')
+		if bundle and not path.endswith('.npz'):
+			path += '.npz'
 		instance = {
 			'needles': self.instance['needles'],
 			'diameter': self.instance['geometry_diameter'],
 			'safezone': self.instance['geometry_safezone'],
 		}
+		if self.instance['drawmode'] != 'none' and self.instance['target_overlays']:
+			instance['targets'] = []
+			for i, overlay in enumerate(self.instance['target_overlays']):
+				coverage = self.instance['engine'].target_coverage(i)
+				instance['targets'].append({
+					'name': overlay.name,
+					'coverage': None if coverage is None else 100. * coverage,
+					'needles': self.target_overlay_needles(i),
+				})
+		if self.instance['danger_overlays']:
+			instance['avoids'] = []
+			for i, overlay in enumerate(self.instance['danger_overlays']):
+				instance['avoids'].append({
+					'name': overlay.name,
+					'needles': [
+						{
+							'needle': item['needle'],
+							'clearance': float(item['clearance']),
+							'voxels': item['voxels'],
+							'volume': item['volume'],
+						}
+						for item in self.danger_overlay_report(i)
+						if item['violation'] or item['voxels'] > 0
+					],
+				})
+		timings = {} if self.draw_profile() else None
 		try:
-			with open(path, 'w') as fp:
-				json.dump(instance, fp, indent='\t')
-				fp.write('\n')
+			if bundle:
+				engine = self.instance['engine']
+				with ablation.timer(timings, 'raster'):
+					rasters = engine.bundle_rasters(
+						self.instance['needles'],
+						self.instance['geometry_diameter'],
+						self.instance['geometry_safezone'],
+					)
+				with ablation.timer(timings, 'write'):
+					ablation.bundle_save(path, instance, engine.grid, rasters)
+			else:
+				with ablation.timer(timings, 'write'), open(path, 'w') as fp:
+					json.dump(instance, fp, indent='\t')
+					fp.write('\n')
 		except IOError as error:
 			wx.MessageBox(
 				str(error),
@@ -1067,6 +1492,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 				wx.OK|wx.ICON_ERROR,
 			)
 			return
+		debug_timings('save', timings)
 		wx.MessageBox(
 			'File saved successfully.',
 			self.title(),
@@ -1083,6 +1509,13 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		debug('insert', index, mode='info')
 		assert self.instance is not None
 		assert self.instance['form'] is None
+		if len(self.instance['needles']) >= ablation.NEEDLE_MAX:
+			wx.MessageBox(
+				'The needle list is full.',
+				self.title(),
+				wx.OK|wx.ICON_INFORMATION,
+			)
+			return
 		if index == 0:
 			point = {
 				'entry': None,
@@ -1095,6 +1528,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			'index': 0,
 			'point': point,
 			'dirty': False,
+			'trajectory': None,
 		}
 		self.needle_list_disable()
 		self.form_show()
@@ -1109,6 +1543,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			'index': index,
 			'point': self.instance['needles'][index - 1].copy(),
 			'dirty': False,
+			'trajectory': None,
 		}
 		self.needle_list_disable()
 		self.form_show()
@@ -1120,10 +1555,29 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		assert self.instance['form'] is None
 		assert index - 1 in range(len(self.instance['needles']))
 		self.instance['needles'].pop(index - 1)
-		self.needle_sizer_refresh()
-		self.layout()
+		self.history_push()
+		self.needle_list_refresh(*range(index, len(self.instance['needles']) + 1))
 		self.draw()
 
+	def on_history_button_click(self, event, action):
+		debug(action, mode='info')
+		assert self.instance is not None
+		assert self.instance['form'] is None
+		assert action in self.history_buttons
+		engine = self.instance['engine']
+		history = self.instance['history']
+		if action == 'undo':
+			self.instance['needles'] = history.undo(engine.cache)
+		else:
+			self.instance['needles'] = history.redo(engine.cache)
+		engine.retained = history.rasters()
+		self.needle_list_refresh()
+		self.needle_list.Refresh()
+		self.draw()
+
+	def on_needle_list_select(self, event):
+		self.needle_list_select()
+
 	def on_needle_view_button_click(self, event, index, which):
 		debug('view', index, which, mode='info')
 		assert self.instance is not None
@@ -1146,14 +1600,15 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		assert self.instance['form'] is not None
 		assert which in ['entry', 'target']
 		self.instance['form']['point'][which] = tuple(self.displayCtx.worldLocation.xyz)
+		self.instance['form']['trajectory'] = None
+		if all(point is not None for point in self.instance['form']['point'].values()):
+			self.instance['form']['dirty'] = True
+		self.form_refresh()
 		if which == 'entry':
 			value = self.form_slider.GetMin()
 		else:
 			value = self.form_slider.GetMax()
 		self.form_slider.SetValue(value)
-		if all(point is not None for point in self.instance['form']['point'].values()):
-			self.instance['form']['dirty'] = True
-		self.form_refresh()
 		if self.instance['form']['dirty']:
 			self.draw()
 
@@ -1161,12 +1616,19 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		debug('slide', event.GetEventType(), event.GetPosition(), mode='info')
 		assert self.instance is not None
 		assert self.instance['form'] is not None
-		assert all(point is not None for point in self.instance['form']['point'].values())
-		entry, target = tuple(self.instance['form']['point'].values())
-		slider = self.form_slider
-		t = (slider.GetValue() - slider.GetMin()) / (slider.GetMax() - slider.GetMin())
-		point = numpy.average([entry, target], 0, [1-t, t])
-		self.displayCtx.worldLocation.xyz = tuple(point)
+		assert self.instance['form']['trajectory'] is not None
+		# thumb tracking is throttled to the display rate; the final position is applied at once
+		if event.GetEventType() == wx.wxEVT_SCROLL_CHANGED:
+			self.form_slider_apply()
+		elif self.form_timer is None:
+			self.form_timer = wx.CallLater(self.form_slider_interval(), self.form_slider_apply)
+
+	def on_needle_snap_checkbox_click(self, event):
+		debug('snap', self.form_snap.GetValue(), mode='info')
+		assert self.instance is not None
+		assert self.instance['form'] is not None
+		self.form_trajectory_refresh()
+		self.form_slider_apply()
 
 	def on_needle_submit_button_click(self, event):
 		debug('submit', mode='info')
@@ -1181,15 +1643,19 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			)
 			return
 		if self.instance['form']['index'] > 0:
-			self.instance['needles'][self.instance['form']['index'] - 1] = self.instance['form']['point']
+			index = self.instance['form']['index']
+			self.instance['needles'][index - 1] = self.instance['form']['point']
 		else:
 			self.instance['needles'].append(self.instance['form']['point'])
+			index = len(self.instance['needles'])
 		self.instance['form'] = None
-		self.needle_sizer_refresh()
+		self.history_push()
+		self.needle_list_refresh(index)
 		self.needle_list_enable()
 		self.form_hide()
 		self.layout()
 		self.draw()
+		self.proposal_next()
 
 	def on_needle_cancel_button_click(self, event):
 		debug('cancel', mode='info')
@@ -1202,6 +1668,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		self.layout()
 		if dirty:
 			self.draw()
+		self.proposal_next()
 
 	def on_geometry_import_button_click(self, event):
 		debug('geometry import', mode='info')
@@ -1219,14 +1686,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		try:
 			with open(path, 'r') as fp:
 				geometry = json.load(fp)
-			assert type(geometry) is dict
-			assert 'diameter' in geometry and type(geometry['diameter']) is int
-			assert geometry['diameter'] >= GEOMETRY_DIAMETER_MIN
-			assert geometry['diameter'] <= GEOMETRY_DIAMETER_MAX
-			assert 'safezone' in geometry and type(geometry['safezone']) is int
-			assert geometry['safezone'] >= GEOMETRY_SAFEZONE_MIN
-			assert geometry['safezone'] <= GEOMETRY_SAFEZONE_MAX
-			assert geometry['diameter'] <= 2 * geometry['safezone']
+			ablation.geometry_check(geometry)
 		except IOError as error:
 			wx.MessageBox(
 				str(error),
@@ -1252,6 +1712,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		self.instance['geometry_safezone'] = geometry['safezone']
 		self.geometry_diameter.SetValue(self.instance['geometry_diameter'])
 		self.geometry_safezone.SetValue(self.instance['geometry_safezone'])
+		self.needle_list_refresh()
 		self.draw()
 
 	def on_geometry_export_button_click(self, event):
@@ -1296,6 +1757,7 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		if self.instance['geometry_safezone'] < self.instance['geometry_diameter'] / 2:
 			self.instance['geometry_safezone'] = math.ceil(self.instance['geometry_diameter'] / 2)
 			self.geometry_safezone.SetValue(self.instance['geometry_safezone'])
+		self.needle_list_refresh()
 		self.draw()
 
 	def on_geometry_safezone_spinctrl_change(self, event):
@@ -1305,8 +1767,17 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		if self.instance['geometry_diameter'] > self.instance['geometry_safezone'] * 2:
 			self.instance['geometry_diameter'] = math.floor(self.instance['geometry_safezone'] * 2)
 			self.geometry_diameter.SetValue(self.instance['geometry_diameter'])
+			self.needle_list_refresh()
 		self.draw()
 
+	def on_draw_readout_checkbox_click(self, event):
+		debug('timings', self.draw_readout.GetValue(), mode='info')
+		assert self.instance is not None
+		self.instance['engine'].profile = self.draw_profile()
+		if not self.draw_readout.GetValue():
+			self.draw_timings_refresh(None)
+		self.layout()
+
 	def on_drawmode_button_click(self, event, mode):
 		debug('drawmode', mode, mode='info')
 		assert self.instance is not None
@@ -1368,6 +1839,10 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		assert self.instance is not None
 		if not self.append_overlay(self.instance['target_overlays']):
 			return
+		timings = {} if self.draw_profile() else None
+		with ablation.timer(timings, 'index'):
+			self.instance['engine'].target_insert(self.instance['target_overlays'][-1].data)
+		debug_timings('target append', timings)
 		self.target_sizer_refresh()
 		self.layout()
 
@@ -1375,15 +1850,147 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		debug('target remove', overlay.name, mode='info')
 		assert self.instance is not None
 		assert overlay in self.instance['target_overlays']
-		self.instance['target_overlays'].remove(overlay)
+		i = self.instance['target_overlays'].index(overlay)
+		self.optimize_cancel()
+		self.instance['target_overlays'].pop(i)
+		self.instance['engine'].target_remove(i)
 		self.target_sizer_refresh()
 		self.layout()
 
+	def on_target_optimize_button_click(self, event, overlay):
+		debug('target optimize', overlay.name, mode='info')
+		assert self.instance is not None
+		assert overlay in self.instance['target_overlays']
+		optimizer = self.instance['optimizer']
+		if optimizer is not None:
+			self.optimize_cancel()
+			self.target_sizer_refresh()
+			self.layout()
+			if optimizer['target'] is overlay:
+				return
+		room = ablation.NEEDLE_MAX - len(self.instance['needles']) - len(self.instance['proposals'])
+		if room <= 0:
+			wx.MessageBox(
+				'The needle list is full.',
+				self.title(),
+				wx.OK|wx.ICON_INFORMATION,
+			)
+			return
+		count = wx.GetNumberFromUser(
+			'Number of needles to propose for the target mask.',
+			'needles',
+			self.title(),
+			1,
+			1,
+			min(room, OPTIMIZER_NEEDLES),
+			self,
+		)
+		if count <= 0:
+			return
+		# queued proposals and the form needle count as placed needles
+		needles = self.instance['needles'] + self.instance['proposals']
+		form = self.instance['form']
+		if form is not None and form['dirty']:
+			needles = needles + [form['point']]
+		optimizer = {
+			'instance': self.instance,
+			'target': overlay,
+			'cancel': threading.Event(),
+		}
+		self.instance['optimizer'] = optimizer
+		threading.Thread(
+			target=self.optimize_worker,
+			args=(optimizer, {} if self.draw_profile() else None),
+			kwargs={
+				'i': self.instance['target_overlays'].index(overlay),
+				'count': count,
+				'needles': [dict(needle) for needle in needles],
+				'diameter': self.instance['geometry_diameter'],
+				'safezone': self.instance['geometry_safezone'],
+				'margin': NEEDLE_MARGIN,
+			},
+			daemon=True,
+		).start()
+		self.target_sizer_refresh()
+		self.layout()
+
+	def optimize_worker(self, optimizer, timings, **kwargs):
+		try:
+			result = optimizer['instance']['engine'].optimize(
+				cancelled=optimizer['cancel'].is_set,
+				timings=timings,
+				**kwargs,
+			)
+		except Exception as error:
+			debug('optimize failed:', repr(error), mode='failure')
+			result = {
+				'needles': None,
+			}
+		if result is not None:
+			wx.CallAfter(self.optimize_publish, optimizer, result, timings)
+
+	def optimize_publish(self, optimizer, result, timings):
+		if self.instance is not optimizer['instance'] or self.instance['optimizer'] is not optimizer:
+			return
+		self.instance['optimizer'] = None
+		self.target_sizer_refresh()
+		self.layout()
+		debug_timings('optimize', timings)
+		if result['needles'] is None:
+			wx.MessageBox(
+				'Needle proposal failed.',
+				self.title(),
+				wx.OK|wx.ICON_ERROR,
+			)
+			return
+		if not result['needles']:
+			wx.MessageBox(
+				'No trajectory reaches the target mask while avoiding the avoid masks.',
+				self.title(),
+				wx.OK|wx.ICON_INFORMATION,
+			)
+			return
+		debug('proposed', len(result['needles']), 'of', result['candidates'], 'candidates', mode='info')
+		self.instance['proposals'].extend(result['needles'])
+		if self.instance['form'] is None:
+			self.proposal_next()
+
+	def optimize_cancel(self):
+		assert self.instance is not None
+		if self.instance['optimizer'] is not None:
+			self.instance['optimizer']['cancel'].set()
+			self.instance['optimizer'] = None
+
+	def proposal_next(self):
+		# proposed needles are reviewed one at a time in the form
+		assert self.instance is not None
+		assert self.instance['form'] is None
+		if not self.instance['proposals']:
+			return
+		if len(self.instance['needles']) >= ablation.NEEDLE_MAX:
+			self.instance['proposals'].clear()
+			return
+		self.instance['form'] = {
+			'index': 0,
+			'point': dict(self.instance['proposals'].pop(0)),
+			'dirty': True,
+			'trajectory': None,
+		}
+		self.needle_list_disable()
+		self.form_show()
+		self.form_title.SetLabel('insert proposed needle ({:d} more)'.format(len(self.instance['proposals'])))
+		self.layout()
+		self.draw()
+
 	def on_danger_insert_button_click(self, event):
 		debug('danger append', mode='info')
 		assert self.instance is not None
 		if not self.append_overlay(self.instance['danger_overlays']):
 			return
+		timings = {} if self.draw_profile() else None
+		with ablation.timer(timings, 'field'):
+			self.instance['engine'].avoid_insert(self.instance['danger_overlays'][-1].data)
+		debug_timings('danger append', timings)
 		self.danger_sizer_refresh()
 		self.layout()
 
@@ -1391,7 +1998,9 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		debug('danger remove', overlay.name, mode='info')
 		assert self.instance is not None
 		assert overlay in self.instance['danger_overlays']
-		self.instance['danger_overlays'].remove(overlay)
+		i = self.instance['danger_overlays'].index(overlay)
+		self.instance['danger_overlays'].pop(i)
+		self.instance['engine'].avoid_remove(i)
 		self.danger_sizer_refresh()
 		self.layout()
 
@@ -1401,17 +2010,6 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 		assert overlay in self.overlayList
 		overlay = self.displayCtx.selectOverlay(overlay)
 
-	def world2voxel(self, coords):
-		assert self.instance is not None
-		image = self.instance['image']
-		coords = numpy.asarray(coords)
-		assert coords.ndim == 1 and coords.size == image.ndim
-		opts = self.displayCtx.getOpts(image)
-		coords = [coords]
-		xformed = opts.transformCoords(coords, 'world', 'voxel', True)
-		xformed = xformed[0]
-		return tuple(xformed.astype(int))
-
 	def voxel2world(self, coords):
 		assert self.instance is not None
 		image = self.instance['image']
@@ -1431,16 +2029,18 @@ class AblationControlPanel(fsleyes.controls.controlpanel.ControlPanel):
 			self.reset()
 			return
 		target_refresh = False
-		for overlay in self.instance['target_overlays']:
+		for i, overlay in reversed(list(enumerate(self.instance['target_overlays']))):
 			if overlay not in self.overlayList:
 				debug('target mask has been removed from overlay list', mode='warning')
-				self.instance['target_overlays'].remove(overlay)
+				self.instance['target_overlays'].pop(i)
+				self.instance['engine'].target_remove(i)
 				target_refresh = True
 		danger_refresh = False
-		for overlay in self.instance['danger_overlays']:
+		for i, overlay in reversed(list(enumerate(self.instance['danger_overlays']))):
 			if overlay not in self.overlayList:
 				debug('danger mask has been removed from overlay list', mode='warning')
-				self.instance['danger_overlays'].remove(overlay)
+				self.instance['danger_overlays'].pop(i)
+				self.instance['engine'].avoid_remove(i)
 				danger_refresh = True
 		if target_refresh:
 			self.target_sizer_refresh()
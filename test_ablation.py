@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+
+import numpy
+
+import ablation
+
+
+def grids():
+	yield (40, 40, 40), numpy.eye(4)
+	vox2world = numpy.diag([.5, .5, 2., 1.])
+	vox2world[:3, 3] = [-10., -10., -40.]
+	yield (40, 40, 40), vox2world
+
+def segments(vox2world, count, seed=0):
+	rng = numpy.random.default_rng(seed)
+	for _ in range(count):
+		entry_ijk, target_ijk = rng.uniform(2, 37, (2, 3))
+		yield tuple(vox2world[:3, :3] @ entry_ijk + vox2world[:3, 3]), tuple(vox2world[:3, :3] @ target_ijk + vox2world[:3, 3])
+
+def test_traverse_contains_sample():
+	for shape, vox2world in grids():
+		world2vox = numpy.linalg.inv(vox2world)
+		zooms = numpy.linalg.norm(vox2world[:3, :3], axis=0)
+		for entry, target in segments(vox2world, 50):
+			sample = ablation.pair2voxels_sample(entry, target, world2vox, zooms, shape)
+			traverse = ablation.pair2voxels_traverse(entry, target, world2vox, shape)
+			assert set(map(tuple, sample)) <= set(map(tuple, traverse))
+
+def test_traverse_connected():
+	for shape, vox2world in grids():
+		world2vox = numpy.linalg.inv(vox2world)
+		for entry, target in segments(vox2world, 50, seed=1):
+			traverse = ablation.pair2voxels_traverse(entry, target, world2vox, shape)
+			assert numpy.all(numpy.abs(numpy.diff(traverse, axis=0)).sum(axis=1) == 1)
+			ends = numpy.floor(numpy.array([entry, target]) @ world2vox[:3, :3].T + world2vox[:3, 3] + .5)
+			assert numpy.array_equal(traverse[[0, -1]], ends)
+
+def test_traverse_point():
+	for shape, vox2world in grids():
+		world2vox = numpy.linalg.inv(vox2world)
+		for entry, _ in segments(vox2world, 10, seed=2):
+			sample = ablation.pair2voxels_sample(entry, entry, world2vox, numpy.ones(3), shape)
+			traverse = ablation.pair2voxels_traverse(entry, entry, world2vox, shape)
+			assert traverse.shape == (1, 3)
+			assert numpy.array_equal(traverse, sample)
+
+def test_segment_distances():
+	rng = numpy.random.default_rng(3)
+	u = numpy.linspace(0, 1, 801)[:, numpy.newaxis]
+	for k in range(100):
+		p0, p1, q0, q1 = rng.normal(size=(4, 3)) * 10
+		if k % 10 == 0:
+			q1 = q0 + (p1 - p0) * rng.uniform(-2, 2) # parallel
+		if k % 17 == 0:
+			q1 = q0.copy()
+		distance = ablation.segment_distances(p0, p1, q0, q1)
+		P = p0 + u * (p1 - p0)
+		Q = q0 + u * (q1 - q0)
+		brute = numpy.linalg.norm(P[:, numpy.newaxis] - Q[numpy.newaxis], axis=-1).min()
+		assert distance <= brute + 1e-9
+		assert distance >= brute - .05
+
+def test_labels_none():
+	engine = ablation.Engine((20, 20, 20), (1., 1., 1.), numpy.eye(4), workers=1)
+	needles = [{'entry': (2., 2., 2.), 'target': (15., 15., 15.)}]
+	assert engine.labels(needles, 'line').any()
+	assert not engine.labels(needles, 'none').any()
+	engine.close()
+
+def test_field_growth(monkeypatch):
+	calls = []
+	capsule_distance = ablation.capsule_distance
+	def counting(*args, **kwargs):
+		calls.append(args[3])
+		return capsule_distance(*args, **kwargs)
+	monkeypatch.setattr(ablation, 'capsule_distance', counting)
+	engine = ablation.Engine((80, 80, 80), (1., 1., 1.), numpy.eye(4), workers=1)
+	needles = [
+		{'entry': (10., 10., 10.), 'target': (40., 40., 40.)},
+		{'entry': (60., 10., 10.), 'target': (40., 50., 40.)},
+	]
+	for safezone in range(5, 11):
+		engine.labels(needles, 'full', 3, safezone)
+	assert len(calls) == 2 * len(needles)
+	for safezone in range(10, 4, -1):
+		engine.labels(needles, 'full', 3, safezone)
+	assert len(calls) == 2 * len(needles)
+	grown = engine.labels(needles, 'full', 3, 8).copy()
+	fresh = ablation.Engine((80, 80, 80), (1., 1., 1.), numpy.eye(4), workers=1)
+	assert numpy.array_equal(grown, fresh.labels(needles, 'full', 3, 8))
+	engine.close()
+	fresh.close()